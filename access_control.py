@@ -1,4 +1,5 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from functools import wraps
+from flask import Blueprint, render_template, redirect, url_for, flash, request, abort
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from forms import RegistrationForm, LoginForm, RequestResetForm, ResetPasswordForm
@@ -12,6 +13,23 @@ from subscription_routes import create_or_update_subscription
 access_control_bp = Blueprint('access_control', __name__)
 
 
+def is_admin(user):
+    """Operators are the confirmed users listed in Config.ADMIN_EMAILS."""
+    admins = {email.lower() for email in getattr(Config, 'ADMIN_EMAILS', ())}
+    return user.is_authenticated and user.is_confirmed and user.email.lower() in admins
+
+
+def admin_required(view):
+    """Restrict a view to operators; anyone else gets a 404 so operational endpoints are not advertised."""
+    @wraps(view)
+    @login_required
+    def wrapped(*args, **kwargs):
+        if not is_admin(current_user):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapped
+
+
 def send_email(to, subject, template):
     msg = Message(
         subject,
@@ -0,0 +1,87 @@
+#ann_benchmark.py
+
+"""
+Benchmark of the approximate (IVF) profile scoring against the exact scan of a population's embedding index.
+Queries are chunk vectors of the population perturbed with noise, so they resemble real AI filter embeddings
+without calling the embedding provider. For every `nprobe` it reports recall@k of the top-k profiles and the
+latency of both paths.
+
+Usage:
+    python ann_benchmark.py --tag US [--queries 50] [--k 100] [--nprobe 1 4 16 64] [--candidate-share 0.5] [--train]
+"""
+
+import argparse
+import statistics
+import time
+import numpy as np
+import ann_index
+import embedding_index
+
+
+def _top_k(scores, k):
+    positive = np.flatnonzero(scores > 0)
+    return set(positive[np.argsort(-scores[positive], kind='stable')[:k]].tolist())
+
+
+def _timed(call):
+    started = time.perf_counter()
+    result = call()
+    return result, time.perf_counter() - started
+
+
+def _latency(values):
+    ordered = sorted(values)
+    return f"p50 {statistics.median(ordered) * 1000:.1f}ms, p95 {ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000:.1f}ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare approximate and exact profile scoring on an embedding index.")
+    parser.add_argument('--tag', required=True, help="population tag with a built embedding index")
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--candidate-share', type=float, default=1.0, help="share of the population used as candidate set")
+    parser.add_argument('--threshold', type=float, default=0.32)
+    parser.add_argument('--noise', type=float, default=0.05)
+    parser.add_argument('--train', action='store_true', help="train the IVF index here when the embedding index has none")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    index = embedding_index.get_index(args.tag)
+    if index is None or not len(index.matrix):
+        raise SystemExit(f"No embedding index with chunks for {args.tag}; build it with embedding_index.py")
+    if index.ann is None:
+        if not args.train:
+            raise SystemExit(f"The index of {args.tag} has no ANN part (under EMBEDDING_ANN_MIN_CHUNKS); pass --train")
+        index.ann, seconds = _timed(lambda: ann_index.IVFIndex.train(index.matrix))
+        print(f"Trained {len(index.ann.centroids)} clusters in {seconds:.1f}s")
+
+    rng = np.random.default_rng(args.seed)
+    positions = np.arange(len(index.profile_ids))
+    if args.candidate_share < 1:
+        positions = np.sort(rng.choice(positions, max(1, int(args.candidate_share * len(positions))), replace=False))
+    queries = np.asarray(index.matrix[rng.choice(len(index.matrix), args.queries)], dtype=np.float32)
+    queries += rng.normal(0, args.noise, queries.shape).astype(np.float32)
+
+    print(f"{args.tag}: {len(index.profile_ids)} profiles, {len(index.matrix)} chunks, {len(index.ann.centroids)} clusters, "
+          f"{len(positions)} candidates, {args.queries} queries")
+    exact, exact_latency = [], []
+    for query in queries:
+        scores, seconds = _timed(lambda: index.exact_score(positions, query, args.threshold))
+        exact.append(_top_k(scores, args.k))
+        exact_latency.append(seconds)
+    print(f"exact       {_latency(exact_latency)}")
+
+    for nprobe in args.nprobe:
+        recalls, latency = [], []
+        for query, expected in zip(queries, exact):
+            scores, seconds = _timed(lambda: index.approximate_score(positions, query, args.threshold, nprobe))
+            latency.append(seconds)
+            if expected:
+                recalls.append(len(_top_k(scores, args.k) & expected) / len(expected))
+        recall = statistics.mean(recalls) if recalls else float('nan')
+        print(f"nprobe {nprobe:<4} {_latency(latency)}, recall@{args.k} {recall:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#ann_index.py
+
+"""
+Approximate nearest-neighbour search over the chunk embeddings of a population (IVF-flat, NumPy only).
+The normalized chunk vectors of an embedding index are clustered with spherical k-means; a query only scores the
+chunks of the `nprobe` clusters whose centroids are closest to it, restricted to the candidate profiles, and sums
+them per profile like the exact path. `nprobe` is the recall/latency knob: more probed clusters find more of the
+matching chunks at a higher cost (see ann_benchmark.py). The index is built next to each embedding index version
+for populations with at least EMBEDDING_ANN_MIN_CHUNKS chunks and used when EMBEDDING_ANN_ENABLED is set.
+"""
+
+import numpy as np
+from config import Config
+from vector_utils import normalize_rows, score_profiles
+
+ENABLED = getattr(Config, 'EMBEDDING_ANN_ENABLED', False)
+# Populations with fewer chunks are always scanned exactly
+MIN_CHUNKS = getattr(Config, 'EMBEDDING_ANN_MIN_CHUNKS', 200000)
+# Candidate sets with fewer profiles are scanned exactly
+MIN_CANDIDATES = getattr(Config, 'EMBEDDING_ANN_MIN_CANDIDATES', 20000)
+# Clusters probed per query
+NPROBE = getattr(Config, 'EMBEDDING_ANN_NPROBE', 16)
+
+KMEANS_ITERATIONS = 10
+# Training vectors per cluster, and the cap on the training sample
+TRAINING_PER_LIST = 50
+MAX_TRAINING_SAMPLE = 200000
+# Rows assigned to clusters per matrix product
+ASSIGN_BATCH = 65536
+
+
+def _assign(matrix, centroids):
+    """Closest centroid of every row, in batches so the product with the centroids stays small."""
+    assignment = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_BATCH):
+        batch = np.asarray(matrix[start:start + ASSIGN_BATCH], dtype=np.float32)
+        assignment[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignment
+
+
+def _kmeans(sample, n_lists, rng):
+    """Spherical k-means: centroids are the normalized means of their rows; empty clusters are reseeded."""
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _assign(sample, centroids)
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=n_lists)
+        filled = counts > 0
+        boundaries = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(sample[order], boundaries, axis=0)
+        if (~filled).any():
+            centroids[~filled] = sample[rng.choice(len(sample), int((~filled).sum()), replace=False)]
+        normalize_rows(centroids)
+    return centroids
+
+
+class IVFIndex:
+    """Cluster centroids and the matrix rows of every cluster (rows of list i are list_rows[list_offsets[i]:list_offsets[i + 1]])."""
+    def __init__(self, centroids, list_offsets, list_rows):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @classmethod
+    def train(cls, matrix, centroids=None, n_lists=None, seed=0):
+        """
+        Cluster the rows of a normalized matrix. Passing the centroids of a previous version only reassigns the rows,
+        which keeps incremental rebuilds cheap.
+        """
+        if centroids is None:
+            rng = np.random.default_rng(seed)
+            n_lists = n_lists or max(1, int(np.sqrt(len(matrix))))
+            sample_size = min(len(matrix), max(n_lists, min(MAX_TRAINING_SAMPLE, TRAINING_PER_LIST * n_lists)))
+            sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype=np.float32)
+            centroids = _kmeans(sample, min(n_lists, sample_size), rng)
+        assignment = _assign(matrix, centroids)
+        list_rows = np.argsort(assignment, kind='stable').astype(np.int64)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))]).astype(np.int64)
+        return cls(centroids.astype(np.float32), list_offsets, list_rows)
+
+    def save(self, path):
+        with open(path, 'wb') as index_file:
+            np.savez(index_file, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['list_offsets'], data['list_rows'])
+
+    def probe(self, query_vector, nprobe):
+        """Matrix rows of the `nprobe` clusters closest to a normalized query, in ascending order."""
+        similarities = self.centroids @ query_vector
+        if nprobe < len(self.centroids):
+            lists = np.argpartition(-similarities, nprobe - 1)[:nprobe]
+        else:
+            lists = np.arange(len(self.centroids))
+        rows = np.concatenate([self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists])
+        # Ascending rows read the memory-mapped matrix sequentially
+        rows.sort()
+        return rows
+
+    def score(self, matrix, owners, profile_count, positions, query_embedding, similarity_threshold, nprobe=None):
+        """
+        Approximate scores of the profiles at `positions` (same semantics as vector_utils.score_profiles):
+        only their chunks in the probed clusters are scored.
+        """
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector = query_vector / (np.linalg.norm(query_vector) or 1)
+        rows = self.probe(query_vector, nprobe or NPROBE)
+        # Candidate filtering: drop chunks of profiles outside the candidate set before scoring
+        wanted = np.zeros(profile_count, dtype=bool)
+        wanted[positions] = True
+        rows = rows[wanted[owners[rows]]]
+        return score_profiles(matrix[rows], owners[rows], profile_count, query_vector, similarity_threshold)[positions]
@@ -0,0 +1,266 @@
+#answer_repair.py
+
+"""
+Local repair of structured LLM answers and classification of query errors.
+Answers that break their schema (malformed JSON, a bare value instead of an object, ratings outside the
+question's scale, choices that differ from the offered options in case, punctuation or labels) are fixed
+here instead of paying for another provider call. Errors are classified so that query tasks only retry
+failures that a new attempt can fix.
+"""
+
+import ast
+import difflib
+import json
+import re
+from pydantic import ValidationError
+from config import Config
+from answer_schema import schema_mapping, ANSWER_FIELDS
+import rate_limiter
+
+# Error classes: worth retrying later, answer unusable (ask again soon), or retrying cannot help
+TRANSIENT, INVALID_ANSWER, PERMANENT = 'transient', 'invalid_answer', 'permanent'
+
+# Minimum similarity for matching a multiple choice answer to one of the offered options
+CHOICE_MATCH_CUTOFF = 0.75
+
+# HTTP statuses of provider responses that may succeed when sent again
+TRANSIENT_STATUSES = {408, 409, 425, 429}
+# Exception class name fragments of network, timeout and database connection errors
+TRANSIENT_ERROR_NAMES = ('Timeout', 'Connection', 'Connect', 'ServiceUnavailable', 'InternalServerError', 'OperationalError')
+
+
+class InvalidAnswer(ValueError):
+    """The provider answer could not be repaired to fit its schema."""
+
+
+def _status_code(exc):
+    return getattr(exc, 'status_code', None) or getattr(getattr(exc, 'response', None), 'status_code', None)
+
+
+def _error_chain(exc):
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        yield exc
+        exc = exc.__cause__ or exc.__context__
+
+
+def classify_error(exc) -> str:
+    """Classify a query failure as TRANSIENT, INVALID_ANSWER or PERMANENT."""
+    for error in _error_chain(exc):
+        if isinstance(error, (rate_limiter.RateLimitExceeded, TimeoutError, ConnectionError)) or rate_limiter.is_rate_limit_error(error):
+            return TRANSIENT
+        if isinstance(error, (InvalidAnswer, ValidationError, json.JSONDecodeError)):
+            return INVALID_ANSWER
+        if isinstance(error, LookupError):
+            # Run spec, profile or question gone (superseded run)
+            return PERMANENT
+        status = _status_code(error)
+        if isinstance(status, int):
+            return TRANSIENT if status >= 500 or status in TRANSIENT_STATUSES else PERMANENT
+        if any(name in type(error).__name__ for name in TRANSIENT_ERROR_NAMES):
+            return TRANSIENT
+    # Output parsers of the structured LLM wrappers raise plain ValueErrors
+    if isinstance(exc, ValueError) and 'json' in str(exc).lower():
+        return INVALID_ANSWER
+    return PERMANENT
+
+
+def raw_output_from_error(exc):
+    """
+    Provider output carried by a parse or validation error of the structured LLM wrapper, or None.
+    Single-field answers are rebuilt from the rejected field value.
+    """
+    for error in _error_chain(exc):
+        if isinstance(error, ValidationError):
+            details = error.errors()
+            for detail in details:
+                if detail['type'] == 'json_invalid' and isinstance(detail.get('input'), str):
+                    return detail['input']
+            if details and all(len(detail['loc']) == 1 for detail in details):
+                return json.dumps({detail['loc'][0]: detail.get('input') for detail in details}, default=str, ensure_ascii=False)
+        elif isinstance(error, ValueError):
+            match = re.search(r'output:\s*(.+)$', str(error), re.DOTALL)
+            if match:
+                return match.group(1)
+    return None
+
+
+def parse_output(text):
+    """Parse provider output leniently: code fences, surrounding prose, single quotes and trailing commas are tolerated."""
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', str(text).strip())
+    candidates = [text]
+    start, end = text.find('{'), text.rfind('}')
+    if 0 <= start < end:
+        candidates.append(text[start:end + 1])
+    for candidate in candidates:
+        for attempt in (candidate, re.sub(r',\s*([}\]])', r'\1', candidate)):
+            try:
+                return json.loads(attempt)
+            except ValueError:
+                pass
+            try:
+                return ast.literal_eval(attempt)
+            except (ValueError, SyntaxError):
+                pass
+    # Not structured at all: keep the text as a bare value
+    return text
+
+
+_RATING_RANGE = r'(\d{1,2})\s*(?:to|-|–|through)\s*(\d{1,3})\b'
+# Optional label after a scale end: 'from 1 (poor) to 10 (excellent)'
+_END_LABEL = r'(?:\s*\([^)]{0,40}\))?'
+# Ways a question states its scale: 'on a scale of 1 to 10', 'rate it from 1 (poor) to 7', 'on a 1-5 scale', '(1-10)'
+SCALE_PATTERNS = (
+    re.compile(r'\bscale\s+(?:of\s+|from\s+)?(\d{1,2})' + _END_LABEL + r'\s*(?:to|-|–|through)\s*(\d{1,3})\b', re.IGNORECASE),
+    re.compile(r'\bfrom\s+(\d{1,2})' + _END_LABEL + r'\s+(?:to|through)\s+(\d{1,3})\b', re.IGNORECASE),
+    re.compile(r'\b' + _RATING_RANGE + r'(?:\s*-?\s*points?)?\s+(?:rating\s+)?scale\b', re.IGNORECASE),
+    re.compile(r'\(\s*(\d{1,2})\s*(?:to|-|–)\s*(\d{1,3})\s*\)', re.IGNORECASE),
+)
+
+
+def scale_range(query_text):
+    """
+    Lowest and highest rating of a scale question, read from an explicit scale in its text, or None if it states
+    none. Other numeric ranges ('people aged 18-30') are ignored; when several scales are stated the last one wins.
+    """
+    ranges = []
+    for pattern in SCALE_PATTERNS:
+        for match in pattern.finditer(query_text or ''):
+            lowest, highest = int(match.group(1)), int(match.group(2))
+            if lowest < highest:
+                ranges.append((match.start(), lowest, highest))
+    if not ranges:
+        return None
+    _, lowest, highest = max(ranges)
+    return lowest, highest
+
+
+def _strip_label(text):
+    """Drop a leading 'a)' / '2.' label and trailing punctuation from an option or answer."""
+    text = re.sub(r'^\(?[a-z0-9][\)\.:]\s+', '', str(text).strip(), flags=re.IGNORECASE)
+    return text.strip().rstrip('?.!').strip()
+
+
+def _normalize(text):
+    return re.sub(r'[^\w\s]', '', _strip_label(text).lower()).strip()
+
+
+def question_options(query_text):
+    """Options offered by a multiple choice question, e.g. 'Which do you prefer: a) tea, b) coffee or c) water?'."""
+    if not query_text or ':' not in query_text:
+        return []
+    tail = query_text.rsplit(':', 1)[1]
+    parts = re.split(r'\n|;|,|\s+or\s+|\s(?=\(?[a-h1-9][\)\.]\s)', tail)
+    options = [_strip_label(part) for part in parts]
+    return [option for option in options if _normalize(option) and len(option) <= 80]
+
+
+def _repair_rating(value, query_text):
+    if isinstance(value, str):
+        match = re.search(r'-?\d+(?:\.\d+)?', value)
+        if match is None:
+            raise InvalidAnswer(f"No rating in answer: {value!r}")
+        value = match.group(0)
+    try:
+        rating = int(round(float(value)))
+    except (TypeError, ValueError):
+        raise InvalidAnswer(f"No rating in answer: {value!r}")
+    scale = scale_range(query_text)
+    if scale is None:
+        # No stated scale to clamp to
+        return rating
+    lowest, highest = scale
+    return min(max(rating, lowest), highest)
+
+
+def _repair_choice(value, query_text):
+    options = question_options(query_text)
+    if str(value).strip() in options:
+        # Already one of the offered options
+        return str(value).strip()
+    answer = _strip_label(value)
+    normalized = {_normalize(option): option for option in options}
+    choice = _normalize(answer)
+    if choice in normalized:
+        return normalized[choice]
+    if not options:
+        return answer
+    labels = re.findall(r'\(?\b([a-h1-9])[\)\.]\s', query_text)
+    if len(labels) == len(options) and choice in labels:
+        return options[labels.index(choice)]
+    containing = [option for key, option in normalized.items() if choice and (key in choice or choice in key)]
+    if len(containing) == 1:
+        return containing[0]
+    close = difflib.get_close_matches(choice, list(normalized), n=1, cutoff=CHOICE_MATCH_CUTOFF)
+    # An answer outside the options is kept as given rather than discarded
+    return normalized[close[0]] if close else answer
+
+
+def _repair_yes_no(value):
+    answer = _normalize(value)
+    if answer in ('yes', 'y', 'true', '1') or answer.startswith('yes '):
+        return 'yes'
+    if answer in ('no', 'n', 'false', '0') or answer.startswith('no '):
+        return 'no'
+    return str(value).strip().lower()
+
+
+def _repair_ranking(value):
+    if isinstance(value, str):
+        value = re.split(r'\n|,|;|>', value)
+    if not isinstance(value, (list, tuple)):
+        raise InvalidAnswer(f"No ranking in answer: {value!r}")
+    items = [re.sub(r'^\(?\d+[\)\.:]\s*', '', str(item).strip()) for item in value]
+    return [item for item in items if item]
+
+
+def repair_answer(answer, schema, query_text):
+    """Return the answer to one question as a dict valid for `schema`, or raise InvalidAnswer."""
+    field = ANSWER_FIELDS[schema]
+    if isinstance(answer, dict) and field not in answer and len(answer) == 1:
+        # Right value under a wrong key
+        answer = {field: next(iter(answer.values()))}
+    elif not isinstance(answer, dict):
+        answer = {field: answer}
+    value = answer.get(field)
+    if value is None:
+        raise InvalidAnswer(f"Answer has no '{field}': {answer!r}")
+
+    if schema == "ScaleSchema":
+        value = _repair_rating(value, query_text)
+    elif schema == "MultipleChoiceSchema":
+        value = _repair_choice(value, query_text)
+    elif schema == "YesNoSchema":
+        value = _repair_yes_no(value)
+    elif schema == "RankingSchema":
+        value = _repair_ranking(value)
+    else:
+        value = str(value).strip()
+
+    try:
+        return schema_mapping[schema].model_validate({field: value}).model_dump()
+    except ValidationError as e:
+        raise InvalidAnswer(f"Answer does not fit {schema}: {e}") from e
+
+
+def repair(content, schema, query_text):
+    """Repair the structured output of a single question; returns the answer JSON."""
+    return json.dumps(repair_answer(parse_output(content), schema, query_text), separators=(',', ':'), ensure_ascii=False)
+
+
+def repair_batch(content, questions, answer_key):
+    """
+    Repair the composite output of a batched call; `questions` carry query_template_id, schema and query_text.
+    Returns the answer JSON keyed like the composite schema.
+    """
+    answers = parse_output(content)
+    if not isinstance(answers, dict):
+        raise InvalidAnswer(f"Batched answer is not an object: {str(content)[:200]!r}")
+    repaired = {}
+    for question in questions:
+        key = answer_key(question['query_template_id'])
+        if key not in answers:
+            raise InvalidAnswer(f"Batched answer has no '{key}'")
+        repaired[key] = repair_answer(answers[key], question['schema'], question['query_text'])
+    return json.dumps(repaired, separators=(',', ':'), ensure_ascii=False)
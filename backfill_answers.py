@@ -0,0 +1,55 @@
+#backfill_answers.py
+
+"""
+Fill the typed answer tables (scale_answers, ranking_answers, ...) from interactions saved before answers were
+parsed at ingest. Safe to run repeatedly: answers already present are skipped.
+
+Usage:
+    python backfill_answers.py [--project-survey-id 123] [--batch-size 5000]
+"""
+
+import argparse
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import Interaction
+from resources import get_session
+from survey import build_answer_rows
+
+
+def backfill(session, project_survey_id=None, batch_size=5000):
+    """Parse interactions in primary key order and insert their typed answers, one transaction per batch."""
+    last_id, parsed = 0, 0
+    while True:
+        query = session.query(Interaction.interaction_id, Interaction.user_id, Interaction.profile_id, Interaction.template_id,
+                              Interaction.project_survey_id, Interaction.answer_text).filter(
+            Interaction.interaction_id > last_id, Interaction.project_survey_id.isnot(None))
+        if project_survey_id is not None:
+            query = query.filter(Interaction.project_survey_id == project_survey_id)
+        batch = query.order_by(Interaction.interaction_id).limit(batch_size).all()
+        if not batch:
+            break
+
+        for model, answer_rows in build_answer_rows([row._asdict() for row in batch]).items():
+            session.execute(pg_insert(model.__table__).on_conflict_do_nothing(), answer_rows)
+        session.commit()
+
+        last_id = batch[-1].interaction_id
+        parsed += len(batch)
+        print(f"Parsed {parsed} interactions (up to id {last_id})")
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the typed answer tables from saved interactions.")
+    parser.add_argument('--project-survey-id', type=int, help="only backfill this project survey")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    session = get_session()
+    try:
+        backfill(session, args.project_survey_id, args.batch_size)
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
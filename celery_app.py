@@ -1,6 +1,7 @@
 import multiprocessing
 import logging
 from celery import Celery
+from kombu import Queue
 from config import Config
 
 # Set multiprocessing to avoid Windows spawn issues
@@ -10,25 +11,49 @@ multiprocessing.set_start_method('spawn', force=True)
 celery = Celery(__name__)
 celery.config_from_object(Config)
 
+# Queues workers consume: the default queue and the survey queues query tasks are scheduled on (see scheduling.py).
+# Start workers with `-Q celery,survey_interactive,survey_priority,survey_standard`, or they ignore the survey queues.
+celery.conf.task_default_queue = 'celery'
+celery.conf.task_queues = (
+    Queue('celery'),
+    Queue('survey_interactive'),
+    Queue('survey_priority'),
+    Queue('survey_standard'),
+)
+
 # Task routes
 celery.conf.task_routes = {
     'profile.query_LLM': {'queue': 'celery'},
-    'survey.process_survey_results': {'queue': 'celery'}  
+    'profile.query_LLM_batch': {'queue': 'celery'},
+    'profile.query_LLM_many': {'queue': 'celery'},
+    'survey.flush_survey_results': {'queue': 'celery'},
+    'survey.plan_survey_run': {'queue': getattr(Config, 'SURVEY_PLANNER_QUEUE', 'celery')},
+    'embedding_index.build_embedding_index': {'queue': 'celery'},
+    'embedding_index.refresh_embedding_indexes': {'queue': 'celery'}
 }
 
 # Correctly register tasks by using imports
 celery.conf.update(
-    imports=("profile", "survey")
+    imports=("profile", "survey", "result_stream", "embedding_index")
 )
 
 celery.conf.result_extended = True  # Ensures result tracking for chord tasks
 celery.conf.task_annotations = {
     'profile.query_LLM': {
-        'rate_limit': '20/m',
-        'max_retries': 5,
-        'retry_backoff': True,
+        # Provider throughput is governed by the shared limiter in rate_limiter.py.
+        # Failures are classified by the task (answer_repair.classify_error): only transient errors back off and retry.
+        # Retries are limited per kind by the task itself (profile._retry), not by Celery's shared retry count.
+        'max_retries': None,
         'retry_backoff_max': 3600,  # 1 hour max delay
-        'autoretry_for': (Exception,),  # Auto-retry for all exceptions
+        'ignore_result': True,  # results are delivered through the survey result stream
+    },
+    'profile.query_LLM_batch': {
+        'max_retries': None,
+        'retry_backoff_max': 3600,
+        'ignore_result': True,
+    },
+    'profile.query_LLM_many': {
+        'ignore_result': True,  # failed requests are re-dispatched as query_LLM tasks
     },
     'celery.chord_unlock': {
         'rate_limit': '10/m'
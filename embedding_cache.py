@@ -0,0 +1,109 @@
+#embedding_cache.py
+
+"""
+Caches for AI filter evaluation.
+Query embeddings are cached per (embedding model, text) in process memory (LRU) and in Redis, so launching,
+resuming or re-running surveys of the same segment does not call the embedding provider again.
+The profile ids an AI filter resolves to are cached per segment definition and population version: the version
+changes whenever profiles are written through the ORM (see embedding_index), so a cached list never outlives the
+profiles it was computed from; profiles written with raw SQL are picked up once the entry expires.
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+import numpy as np
+from config import Config
+from resources import get_redis
+
+EMBEDDING_PREFIX = "query_embedding_cache"
+EMBEDDING_INDEX_KEY = f"{EMBEDDING_PREFIX}:index"
+SEGMENT_PREFIX = "segment_profiles_cache"
+PROFILES_VERSION_KEY = "profiles_version"
+
+EMBEDDING_TTL = getattr(Config, 'QUERY_EMBEDDING_CACHE_TTL', 30 * 24 * 3600)
+EMBEDDING_MAX_ENTRIES = getattr(Config, 'QUERY_EMBEDDING_CACHE_MAX_ENTRIES', 100000)
+# Query embeddings kept per process
+PROCESS_CACHE_SIZE = 256
+SEGMENT_TTL = getattr(Config, 'SEGMENT_PROFILES_CACHE_TTL', 24 * 3600)
+
+# Segment columns that decide which profiles match (see filter.Filter)
+SEGMENT_COLUMNS = ('gender', 'age_min', 'age_max', 'location', 'ethnicity', 'occupation', 'education_level', 'religion',
+                   'health_status', 'legal_status', 'marital_status', 'income_range', 'ai_filter')
+
+# Profile columns segments are filtered on (see filter.Filter); other profile writes leave cached segments valid
+PROFILE_FILTER_COLUMNS = ('tags', 'gender', 'birth_date', 'location', 'education_level', 'occupation', 'income_range',
+                          'ethnicity', 'religion', 'health_status', 'legal_status', 'marital_status')
+
+_embeddings = OrderedDict()  # (model, text) -> embedding
+
+
+def _embedding_key(model, text):
+    digest = hashlib.sha256(json.dumps([model, text], ensure_ascii=False).encode('utf-8')).hexdigest()
+    return f"{EMBEDDING_PREFIX}:{digest}"
+
+
+def _remember(cache_key, embedding):
+    _embeddings[cache_key] = embedding
+    _embeddings.move_to_end(cache_key)
+    while len(_embeddings) > PROCESS_CACHE_SIZE:
+        _embeddings.popitem(last=False)
+
+
+def get_query_embedding(embed, model, text):
+    """Embedding of a query text, from the process cache, Redis, or `embed(text)` (the embedding provider)."""
+    cache_key = (model, text)
+    embedding = _embeddings.get(cache_key)
+    if embedding is not None:
+        _embeddings.move_to_end(cache_key)
+        return embedding
+
+    r = get_redis()
+    key = _embedding_key(model, text)
+    raw = r.get(key)
+    if raw is not None:
+        embedding = np.frombuffer(raw, dtype=np.float32)
+        r.zadd(EMBEDDING_INDEX_KEY, {key: time.time()})
+    else:
+        embedding = np.asarray(embed(text), dtype=np.float32)
+        now = time.time()
+        pipe = r.pipeline()
+        pipe.set(key, embedding.tobytes(), ex=EMBEDDING_TTL)
+        pipe.zadd(EMBEDDING_INDEX_KEY, {key: now})
+        pipe.zremrangebyscore(EMBEDDING_INDEX_KEY, '-inf', now - EMBEDDING_TTL)
+        pipe.zcard(EMBEDDING_INDEX_KEY)
+        size = pipe.execute()[-1]
+        if size > EMBEDDING_MAX_ENTRIES:
+            # Least recently used entries go first
+            evicted = [member for member, _ in r.zpopmin(EMBEDDING_INDEX_KEY, size - EMBEDDING_MAX_ENTRIES)]
+            if evicted:
+                r.delete(*evicted)
+    _remember(cache_key, embedding)
+    return embedding
+
+
+def bump_profiles_version(r):
+    """Invalidate the cached segment profile lists after profiles changed."""
+    r.incr(PROFILES_VERSION_KEY)
+
+
+def population_version(r):
+    """Version of the profile data segment lists are resolved against."""
+    return int(r.get(PROFILES_VERSION_KEY) or 0)
+
+
+def segment_key(filter_model, population_tag, similarity_threshold, version):
+    definition = [filter_model.id, population_tag, similarity_threshold, version] + [getattr(filter_model, column) for column in SEGMENT_COLUMNS]
+    digest = hashlib.sha256(json.dumps(definition, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return f"{SEGMENT_PREFIX}:{filter_model.id}:{digest}"
+
+
+def lookup_segment(r, key):
+    """Cached profile ids of a segment, best match first, or None."""
+    raw = r.get(key)
+    return json.loads(raw) if raw is not None else None
+
+
+def store_segment(r, key, profile_ids):
+    r.set(key, json.dumps(profile_ids), ex=SEGMENT_TTL)
@@ -0,0 +1,350 @@
+#embedding_index.py
+
+"""
+Persistent embedding index per population.
+The normalized chunk embeddings of every profile of a population tag are stored in one contiguous float32 `.npy`
+file that web and worker processes memory-map, next to an id/offset table (the chunks of profile_ids[i] are rows
+offsets[i]:offsets[i + 1]) and a JSON manifest with the current version. AI filters score candidates against the
+mapped matrix instead of reading ARRAY(Float) columns through the ORM. Large populations also get an approximate
+nearest-neighbour index (ann_index.py) stored with each version.
+
+Profiles written through the ORM are marked dirty when their tags, chunks or embeddings change; a debounced task
+rebuilds the affected indexes incrementally (dirty profiles are re-read, the others are copied from the previous
+version) and publishes a new version with atomic renames. Profiles missing from an index are scored from the
+database, so a stale index never hides new profiles. Profiles changed with raw SQL need a full rebuild:
+    python embedding_index.py --tag US
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+import numpy as np
+from celery import shared_task
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session
+from config import Config
+from models import ProfileModel
+from resources import get_redis, get_session
+from vector_utils import chunk_embedding_columns, stack_chunk_embeddings, score_profiles
+import ann_index
+import embedding_cache
+
+INDEX_DIR = getattr(Config, 'EMBEDDING_INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_index'))
+# Bump when the file layout changes so old indexes are rebuilt instead of read
+INDEX_FORMAT = 1
+# Profiles read from the database per query while building
+BUILD_BATCH_SIZE = 2000
+# Seconds between a profile change and the incremental rebuild, so bulk updates produce one rebuild
+REBUILD_DELAY = getattr(Config, 'EMBEDDING_INDEX_REBUILD_DELAY', 60)
+# Candidate share of a population above which the whole matrix is scanned instead of gathering candidate rows
+FULL_SCAN_SHARE = 0.3
+
+DIRTY_KEY = "embedding_index_dirty"
+REBUILD_SCHEDULED_KEY = "embedding_index_rebuild_scheduled"
+BUILD_LOCK_TIMEOUT = 3600
+
+# Columns whose changes invalidate the indexed embeddings of a profile
+INDEXED_COLUMNS = ('tags', 'llm_persona_chunks', 'llm_persona_embeddings', 'llm_typical_day_chunks', 'llm_typical_day_embeddings')
+
+_indexes = {}  # population tag -> EmbeddingIndex
+
+
+class EmbeddingIndex:
+    """Memory-mapped embedding matrix of a population with its id/offset table."""
+    def __init__(self, tag, version, matrix, profile_ids, offsets, manifest_mtime, ann=None):
+        self.tag = tag
+        self.version = version
+        self.matrix = matrix
+        self.profile_ids = profile_ids  # sorted
+        self.offsets = offsets
+        self.manifest_mtime = manifest_mtime
+        self.ann = ann  # ann_index.IVFIndex over the matrix rows, for large populations
+        self._owners = None
+
+    @property
+    def owners(self):
+        """Position in profile_ids of the profile owning each matrix row."""
+        if self._owners is None:
+            self._owners = np.repeat(np.arange(len(self.profile_ids)), np.diff(self.offsets))
+        return self._owners
+
+    def locate(self, candidate_ids):
+        """Positions of the candidates present in the index, and the ids of the candidates it does not hold."""
+        candidate_ids = np.unique(np.asarray(candidate_ids, dtype=np.int64))
+        positions = np.searchsorted(self.profile_ids, candidate_ids)
+        found = positions < len(self.profile_ids)
+        found[found] = self.profile_ids[positions[found]] == candidate_ids[found]
+        return positions[found], candidate_ids[~found]
+
+    def score(self, positions, query_embedding, similarity_threshold, nprobe=None):
+        """
+        Scores of the profiles at `positions`, with the same semantics as vector_utils.score_profiles.
+        Large candidate sets of large populations are scored approximately when the ANN index is enabled.
+        """
+        if self.ann is not None and ann_index.ENABLED and len(positions) >= ann_index.MIN_CANDIDATES:
+            return self.approximate_score(positions, query_embedding, similarity_threshold, nprobe)
+        return self.exact_score(positions, query_embedding, similarity_threshold)
+
+    def approximate_score(self, positions, query_embedding, similarity_threshold, nprobe=None):
+        return self.ann.score(self.matrix, self.owners, len(self.profile_ids), positions, query_embedding, similarity_threshold, nprobe)
+
+    def exact_score(self, positions, query_embedding, similarity_threshold):
+        if len(positions) >= FULL_SCAN_SHARE * len(self.profile_ids):
+            return score_profiles(self.matrix, self.owners, len(self.profile_ids), query_embedding, similarity_threshold)[positions]
+        # Gather only the chunk rows of the candidates
+        starts, counts = self.offsets[positions], np.diff(self.offsets)[positions]
+        rows = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        owners = np.repeat(np.arange(len(positions)), counts)
+        return score_profiles(self.matrix[rows], owners, len(positions), query_embedding, similarity_threshold)
+
+
+def _safe_tag(tag):
+    return re.sub(r'[^A-Za-z0-9_-]', '_', tag)
+
+def manifest_path(tag):
+    return os.path.join(INDEX_DIR, f"{_safe_tag(tag)}.json")
+
+def _data_paths(tag, version):
+    base = os.path.join(INDEX_DIR, f"{_safe_tag(tag)}.v{version}")
+    return f"{base}.npy", f"{base}.ids.npy", f"{base}.ivf.npz"
+
+def build_lock_key(tag):
+    return f"embedding_index_build_lock_{tag}"
+
+
+def read_manifest(tag):
+    try:
+        with open(manifest_path(tag)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('format') == INDEX_FORMAT else None
+
+
+def get_index(tag):
+    """The current index of a population tag, memory-mapped once per process and version; None if not built yet."""
+    try:
+        mtime = os.stat(manifest_path(tag)).st_mtime
+    except OSError:
+        return None
+    index = _indexes.get(tag)
+    if index is not None and index.manifest_mtime == mtime:
+        return index
+    manifest = read_manifest(tag)
+    if manifest is None:
+        return None
+    matrix_path, ids_path, ann_path = _data_paths(tag, manifest['version'])
+    try:
+        matrix = np.load(matrix_path, mmap_mode='r')
+        table = np.load(ids_path)
+        ann = ann_index.IVFIndex.load(ann_path) if manifest.get('ann') else None
+    except (OSError, ValueError):
+        return None
+    index = EmbeddingIndex(tag, manifest['version'], matrix, table[0, :-1], table[1], mtime, ann)
+    _indexes[tag] = index
+    return index
+
+
+def _read_profiles(session, tag, profile_ids=None):
+    """Stack the embeddings of the tag's profiles (all of them, or those among `profile_ids`) in id order."""
+    query = session.query(*chunk_embedding_columns()).filter(ProfileModel.tags.contains(tag))
+    if profile_ids is None:
+        rows = query.order_by(ProfileModel.id).yield_per(BUILD_BATCH_SIZE)
+        return stack_chunk_embeddings(rows, keep_empty=True)
+    rows = []
+    profile_ids = sorted(profile_ids)
+    for start in range(0, len(profile_ids), BUILD_BATCH_SIZE):
+        rows.extend(query.filter(ProfileModel.id.in_(profile_ids[start:start + BUILD_BATCH_SIZE])).all())
+    return stack_chunk_embeddings(rows, keep_empty=True)
+
+
+def _merge(parts):
+    """Combine (profile ids, matrix, owners) parts into one index ordered by profile id."""
+    profile_ids = np.concatenate([part[0] for part in parts])
+    counts = np.concatenate([np.bincount(part[2], minlength=len(part[0])) for part in parts])
+    matrices = [part[1] for part in parts if part[1].size]
+    dimension = matrices[0].shape[1] if matrices else 0
+    matrix = np.concatenate(matrices) if matrices else np.empty((0, dimension), dtype=np.float32)
+    # Reorder the chunk blocks together with their profiles
+    order = np.argsort(profile_ids, kind='stable')
+    chunk_order = np.argsort(np.repeat(profile_ids, counts), kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(counts[order])]).astype(np.int64)
+    return profile_ids[order], matrix[chunk_order], offsets
+
+
+def _write(tag, version, profile_ids, matrix, offsets, ann=None):
+    """Write the data files of a version, then switch the manifest to it atomically."""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    matrix_path, ids_path, ann_path = _data_paths(tag, version)
+    # Row 0 holds the profile ids (padded by one), row 1 the chunk offsets
+    table = np.zeros((2, len(profile_ids) + 1), dtype=np.int64)
+    table[0, :len(profile_ids)] = profile_ids
+    table[1] = offsets
+    for path, array in ((matrix_path, np.ascontiguousarray(matrix, dtype=np.float32)), (ids_path, table)):
+        with open(path + '.tmp', 'wb') as data_file:
+            np.save(data_file, array)
+        os.replace(path + '.tmp', path)
+    if ann is not None:
+        ann.save(ann_path + '.tmp')
+        os.replace(ann_path + '.tmp', ann_path)
+    manifest = {'format': INDEX_FORMAT, 'tag': tag, 'version': version, 'profiles': int(len(profile_ids)),
+                'chunks': int(matrix.shape[0]), 'dimension': int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+                'ann': ann is not None, 'built_at': time.time()}
+    with open(manifest_path(tag) + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path(tag) + '.tmp', manifest_path(tag))
+
+    # Keep the previous version for processes that still map it
+    for old_version in range(max(version - 20, 1), version - 1):
+        for path in _data_paths(tag, old_version):
+            if os.path.exists(path):
+                os.remove(path)
+    return manifest
+
+
+def build(tag, dirty_ids=None, full=False):
+    """
+    Build a new version of a population's index and return its manifest.
+    Incremental builds re-read only `dirty_ids` and copy the other profiles from the current version.
+    """
+    r = get_redis()
+    if not r.set(build_lock_key(tag), 1, nx=True, ex=BUILD_LOCK_TIMEOUT):
+        print(f"Embedding index of {tag} is already being built")
+        return None
+    session = get_session()
+    try:
+        manifest = read_manifest(tag)
+        current = None if full or manifest is None else get_index(tag)
+        if current is None:
+            profile_ids, matrix, offsets = _merge([_read_profiles(session, tag)])
+        else:
+            dirty = np.unique(np.asarray(sorted(dirty_ids or ()), dtype=np.int64))
+            kept = ~np.isin(current.profile_ids, dirty)
+            kept_rows = np.repeat(kept, np.diff(current.offsets))
+            kept_part = (current.profile_ids[kept], np.asarray(current.matrix[kept_rows]), np.repeat(np.arange(kept.sum()), np.diff(current.offsets)[kept]))
+            profile_ids, matrix, offsets = _merge([kept_part, _read_profiles(session, tag, dirty.tolist())])
+        ann = None
+        if len(matrix) >= ann_index.MIN_CHUNKS:
+            # Incremental builds keep the clusters of the current version and only reassign the rows
+            previous = current.ann if current is not None and current.ann is not None and current.ann.centroids.shape[1] == matrix.shape[1] else None
+            ann = ann_index.IVFIndex.train(matrix, centroids=previous.centroids if previous is not None else None)
+        version = (manifest or {}).get('version', 0) + 1
+        manifest = _write(tag, version, profile_ids, matrix, offsets, ann)
+        print(f"Built embedding index {tag} v{version}: {manifest['profiles']} profiles, {manifest['chunks']} chunks")
+        return manifest
+    finally:
+        session.close()
+        r.delete(build_lock_key(tag))
+
+
+def indexed_tags():
+    """Population tags that have an index."""
+    if not os.path.isdir(INDEX_DIR):
+        return []
+    tags = []
+    for name in os.listdir(INDEX_DIR):
+        if name.endswith('.json'):
+            manifest = read_manifest(name[:-len('.json')])
+            if manifest is not None:
+                tags.append(manifest['tag'])
+    return tags
+
+
+def schedule_rebuild(r=None):
+    """Enqueue the incremental rebuild unless one is already scheduled."""
+    r = r or get_redis()
+    if r.set(REBUILD_SCHEDULED_KEY, 1, nx=True, ex=REBUILD_DELAY + BUILD_LOCK_TIMEOUT):
+        refresh_embedding_indexes.apply_async(countdown=REBUILD_DELAY)
+
+
+def schedule_build(tag):
+    """Enqueue the first build of a population's index."""
+    if get_redis().set(build_lock_key(tag) + '_scheduled', 1, nx=True, ex=BUILD_LOCK_TIMEOUT):
+        build_embedding_index.delay(tag)
+
+
+@shared_task(name='embedding_index.build_embedding_index')
+def build_embedding_index(tag, full=True):
+    manifest = build(tag, full=full)
+    get_redis().delete(build_lock_key(tag) + '_scheduled')
+    return manifest
+
+
+@shared_task(name='embedding_index.refresh_embedding_indexes')
+def refresh_embedding_indexes():
+    """Rebuild every existing index incrementally with the profiles changed since the last refresh."""
+    r = get_redis()
+    r.delete(REBUILD_SCHEDULED_KEY)
+    pipe = r.pipeline()
+    pipe.smembers(DIRTY_KEY)
+    pipe.delete(DIRTY_KEY)
+    dirty_ids = [int(profile_id) for profile_id in pipe.execute()[0]]
+    if not dirty_ids:
+        return
+    for tag in indexed_tags():
+        if build(tag, dirty_ids=dirty_ids) is None:
+            # Another build holds the lock: try again later with the same profiles
+            r.sadd(DIRTY_KEY, *dirty_ids)
+            schedule_rebuild(r)
+            return
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_profiles(session, flush_context):
+    """
+    Remember profiles whose indexed columns were written in this transaction, and whether any profile was added,
+    deleted or had a segment filter column changed. Summary-only updates touch neither.
+    """
+    changed = session.info.setdefault('embedding_index_dirty', set())
+    for target in session.new:
+        if isinstance(target, ProfileModel):
+            changed.add(target.id)
+    for target in session.dirty:
+        if isinstance(target, ProfileModel):
+            attrs = sa_inspect(target).attrs
+            if any(getattr(attrs, column).history.has_changes() for column in INDEXED_COLUMNS):
+                changed.add(target.id)
+            elif any(getattr(attrs, column).history.has_changes() for column in embedding_cache.PROFILE_FILTER_COLUMNS):
+                session.info['profiles_changed'] = True
+    for target in session.deleted:
+        if isinstance(target, ProfileModel):
+            changed.add(target.id)
+    if changed:
+        session.info['profiles_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _mark_changed_profiles(session):
+    changed = session.info.pop('embedding_index_dirty', None)
+    if not session.info.pop('profiles_changed', False):
+        return
+    try:
+        r = get_redis()
+        # Cached segment profile lists were resolved against the previous profiles
+        embedding_cache.bump_profiles_version(r)
+        if changed:
+            r.sadd(DIRTY_KEY, *changed)
+            schedule_rebuild(r)
+    except Exception as e:
+        # The committed profile changes stand; the index catches up on the next full build
+        print(f"Could not mark {len(changed or ())} profiles for the embedding index refresh: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_profiles(session):
+    session.info.pop('embedding_index_dirty', None)
+    session.info.pop('profiles_changed', None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the memory-mapped embedding index of a population from scratch.")
+    parser.add_argument('--tag', required=True, help="population tag")
+    args = parser.parse_args()
+    if build(args.tag, full=True) is None:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
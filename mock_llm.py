@@ -0,0 +1,165 @@
+#mock_llm.py
+
+"""
+Local mock LLM provider for measuring the survey pipeline without paying a real provider.
+Selected like the other providers through the llm_id of the user's LLM settings (MOCK_LLM_ID).
+It answers structured calls with schema-valid random answers after a configurable latency, and fails a
+configurable share of calls with provider errors or 429 rate-limit responses.
+
+Config.MOCK_LLM (all keys optional):
+    latency:          {'distribution': 'lognormal' | 'normal' | 'uniform' | 'constant', 'median': 1.0, 'sigma': 0.5,
+                       'min': 0.2, 'max': 3.0}  (seconds)
+    error_rate:       share of calls failing with a server error
+    rate_limit_rate:  share of calls failing with HTTP 429 and a Retry-After header
+    record_latencies: push every call's latency to a Redis list read by survey_load_driver.py
+"""
+
+import asyncio
+import json
+import random
+import time
+import typing
+from pydantic import BaseModel
+from config import Config
+
+MOCK_LLM_ID = getattr(Config, 'MOCK_LLM_ID', 99)
+LATENCY_KEY = "mock_llm_latencies"
+# Requests per minute the shared rate limiter allows the mock provider unless Config.LLM_RATE_LIMITS sets one
+RATE_LIMIT = 60000
+
+DEFAULT_SETTINGS = {
+    'latency': {'distribution': 'lognormal', 'median': 1.0, 'sigma': 0.5},
+    'error_rate': 0.0,
+    'rate_limit_rate': 0.0,
+    'record_latencies': False,
+}
+
+# Plausible values for the fields of the answer schemas in answer_schema.schema_mapping
+FIELD_VALUES = {
+    'rating': lambda: random.randint(1, 5),
+    'answer': lambda: random.choice(['yes', 'no']),
+    'choice': lambda: random.choice(['option a', 'option b', 'option c', 'option d']),
+    'response': lambda: random.choice([
+        'I mostly agree, it fits my daily routine.',
+        'Not really relevant for me at the moment.',
+        'It depends on the price and on how much time it saves.',
+        'I would try it if friends recommended it.',
+    ]),
+    'ranking': lambda: random.sample(['item 1', 'item 2', 'item 3', 'item 4'], 4),
+}
+
+
+class MockProviderError(Exception):
+    """Server-side failure of the mock provider; carries status_code and response headers like provider SDK errors."""
+    def __init__(self, status_code: int, message: str, headers: dict = None):
+        super().__init__(f"{status_code} {message}")
+        self.status_code = status_code
+        self.response = type('MockHTTPResponse', (), {'status_code': status_code, 'headers': headers or {}})()
+
+
+class MockResponse:
+    """Completion response exposing the text and token usage the way llama_index responses do."""
+    def __init__(self, text: str, prompt_tokens: int, completion_tokens: int):
+        self.text = text
+        self.raw = {'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}}
+        self.additional_kwargs = {}
+
+    def __str__(self):
+        return self.text
+
+
+def settings() -> dict:
+    return {**DEFAULT_SETTINGS, **getattr(Config, 'MOCK_LLM', {})}
+
+
+def sample_latency(latency: dict) -> float:
+    """Draw one call latency in seconds from the configured distribution."""
+    distribution = latency.get('distribution', 'lognormal')
+    median = latency.get('median', 1.0)
+    if distribution == 'constant':
+        value = median
+    elif distribution == 'uniform':
+        value = random.uniform(latency.get('min', 0), latency.get('max', 2 * median))
+    elif distribution == 'normal':
+        value = random.gauss(median, latency.get('sigma', 0.5))
+    else:
+        value = random.lognormvariate(0, latency.get('sigma', 0.5)) * median
+    return min(max(value, latency.get('min', 0)), latency.get('max', float('inf')))
+
+
+def _sample_type(annotation, name: str):
+    origin = typing.get_origin(annotation)
+    if origin is typing.Literal:
+        return random.choice(typing.get_args(annotation))
+    if origin in (list, typing.List):
+        item_type = (typing.get_args(annotation) or (str,))[0]
+        return [_sample_type(item_type, name) for _ in range(3)]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return sample_answer(annotation)
+    if annotation is int:
+        return random.randint(1, 5)
+    if annotation is float:
+        return round(random.uniform(0, 1), 2)
+    if annotation is bool:
+        return random.choice([True, False])
+    return f"mock {name}"
+
+
+def sample_answer(schema_class) -> dict:
+    """Random answer that validates against a Pydantic schema, including composite (batched) schemas."""
+    answer = {}
+    for name, field in schema_class.model_fields.items():
+        answer[name] = FIELD_VALUES[name]() if name in FIELD_VALUES else _sample_type(field.annotation, name)
+    return answer
+
+
+class MockStructuredLLM:
+    """Structured wrapper returned by MockLLM.as_structured_llm, with the interface used by profile.query_LLM."""
+    def __init__(self, llm, output_cls):
+        self.llm = llm
+        self.output_cls = output_cls
+
+    def messages_to_prompt(self, messages) -> str:
+        return "\n".join(f"{message.role.value}: {message.content}" for message in messages)
+
+    def _outcome(self, prompt: str):
+        """Return (latency, response or exception) for one call."""
+        config = settings()
+        latency = sample_latency(config['latency'])
+        roll = random.random()
+        if roll < config['rate_limit_rate']:
+            return latency, MockProviderError(429, "Too Many Requests", {'retry-after': '2'})
+        if roll < config['rate_limit_rate'] + config['error_rate']:
+            return latency, MockProviderError(500, "Mock provider error")
+        content = json.dumps(sample_answer(self.output_cls))
+        return latency, MockResponse(content, max(1, len(prompt) // 4), max(1, len(content) // 4))
+
+    def _record(self, latency: float):
+        if settings()['record_latencies']:
+            from resources import get_redis
+            get_redis().rpush(LATENCY_KEY, latency)
+
+    def complete(self, prompt: str):
+        latency, outcome = self._outcome(prompt)
+        time.sleep(latency)
+        self._record(latency)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def acomplete(self, prompt: str):
+        latency, outcome = self._outcome(prompt)
+        await asyncio.sleep(latency)
+        self._record(latency)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class MockLLM:
+    """Mock provider client, created by resources.get_llm_client for MOCK_LLM_ID."""
+    def __init__(self, model: str = "mock-model", **kwargs):
+        self.model = model
+
+    def as_structured_llm(self, output_cls):
+        return MockStructuredLLM(self, output_cls)
@@ -6,12 +6,12 @@ This module defines the SQLAlchemy ORM models representing the core data structu
 - User management (User, Subscription, Invitation)
 - Survey components (SurveyTemplate, QueryTemplate, ProjectSurvey)
 - Population segmentation (Population, FilterModel, ProfileModel)
-- Interaction tracking (Interaction)
+- Interaction tracking (Interaction) and typed answers parsed from it (ScaleAnswer, RankingAnswer, ...)
 - Project organization (Project)
 Note: Some models (like ProfileView) are database views rather than base tables.
 """
 
-from sqlalchemy import Column, Integer, Text, Numeric, ForeignKey, DateTime, String, Float
+from sqlalchemy import Column, Integer, BigInteger, Text, Numeric, ForeignKey, DateTime, String, Float, UniqueConstraint
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
@@ -165,6 +165,11 @@ class ProfileModel(db.Model):
     llm_typical_day_embeddings = db.Column(ARRAY(Float), nullable=True)
     llm_persona_chunks = db.Column(ARRAY(db.Text), nullable=True)
     llm_typical_day_chunks = db.Column(ARRAY(db.Text), nullable=True)
+
+    # Materialized prompt summary, maintained by profile.Profile.materialize_summary
+    summary = db.Column(db.Text, nullable=True)
+    summary_version = db.Column(db.Integer, nullable=True)
+    summary_age = db.Column(db.Integer, nullable=True)
     
     # Relationship to interactions
     interactions = relationship('Interaction', back_populates='profile')
@@ -198,6 +203,8 @@ class ProfileView(db.Model):
 # Define Interaction model
 class Interaction(db.Model):
     __tablename__ = 'interactions'
+    # One answer per run question and respondent, so redelivered results are not saved twice
+    __table_args__ = (UniqueConstraint('project_survey_id', 'profile_id', 'template_id', name='uq_interactions_answer'),)
 
     interaction_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, nullable=False)
@@ -208,6 +215,9 @@ class Interaction(db.Model):
     template_id = Column(Integer, ForeignKey('query_templates.id'), nullable=False)
     interaction_timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
     project_survey_id = Column(Integer, ForeignKey('query_templates.id'), nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    llm_model = Column(Text, nullable=True)
     
     # Relationships
     profile = relationship("ProfileModel", back_populates="interactions")
@@ -224,6 +234,60 @@ class Interaction(db.Model):
     )
 
 
+# Typed answers, parsed from interactions.answer_text once when results are saved (see survey.collect_results).
+# Keyed by (project_survey_id, query_template_id, profile_id) so the analysis queries are indexed aggregations.
+class ScaleAnswer(db.Model):
+    __tablename__ = 'scale_answers'
+
+    project_survey_id = Column(Integer, ForeignKey('project_survey.id', ondelete='CASCADE'), primary_key=True)
+    query_template_id = Column(Integer, ForeignKey('query_templates.id'), primary_key=True)
+    profile_id = Column(Integer, ForeignKey('profiles.id'), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    rating = Column(Integer, nullable=False)
+
+
+class OpenEndedAnswer(db.Model):
+    __tablename__ = 'open_ended_answers'
+
+    project_survey_id = Column(Integer, ForeignKey('project_survey.id', ondelete='CASCADE'), primary_key=True)
+    query_template_id = Column(Integer, ForeignKey('query_templates.id'), primary_key=True)
+    profile_id = Column(Integer, ForeignKey('profiles.id'), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    response = Column(Text, nullable=False)
+
+
+class MultipleChoiceAnswer(db.Model):
+    __tablename__ = 'multiple_choice_answers'
+
+    project_survey_id = Column(Integer, ForeignKey('project_survey.id', ondelete='CASCADE'), primary_key=True)
+    query_template_id = Column(Integer, ForeignKey('query_templates.id'), primary_key=True)
+    profile_id = Column(Integer, ForeignKey('profiles.id'), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    choice = Column(Text, nullable=False)
+
+
+class YesNoAnswer(db.Model):
+    __tablename__ = 'yes_no_answers'
+
+    project_survey_id = Column(Integer, ForeignKey('project_survey.id', ondelete='CASCADE'), primary_key=True)
+    query_template_id = Column(Integer, ForeignKey('query_templates.id'), primary_key=True)
+    profile_id = Column(Integer, ForeignKey('profiles.id'), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    answer = Column(Text, nullable=False)
+
+
+class RankingAnswer(db.Model):
+    """One row per ranked item; rank 1 is the first item of the answer."""
+    __tablename__ = 'ranking_answers'
+
+    project_survey_id = Column(Integer, ForeignKey('project_survey.id', ondelete='CASCADE'), primary_key=True)
+    query_template_id = Column(Integer, ForeignKey('query_templates.id'), primary_key=True)
+    profile_id = Column(Integer, ForeignKey('profiles.id'), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    item = Column(Text, nullable=False)
+
+
 # Project model
 class Project(db.Model):
     __tablename__ = 'projects'
@@ -300,6 +364,8 @@ class ProjectSurvey(db.Model):
     completion_percentage = Column(Integer, nullable=True)
     segment_id = db.Column(db.Integer, db.ForeignKey('filters.id'), nullable=False)
     respondents = Column(Integer, nullable=True)
+    prompt_tokens = Column(BigInteger, nullable=True, default=0)
+    completion_tokens = Column(BigInteger, nullable=True, default=0)
     
     project = db.relationship('Project', back_populates='project_surveys')
     survey_template = db.relationship('SurveyTemplate', back_populates='project_surveys')
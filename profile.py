@@ -8,49 +8,411 @@ The module uses Celery for asynchronous task processing and Redis for progress t
 from dataclasses import dataclass
 from datetime import date, datetime
 from typing import Optional
-from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy.orm import Session, defer
+from sqlalchemy import text, event, inspect as sa_inspect
 from models import ProfileModel, Population, LLM, User
-from answer_schema import schema_mapping
+from answer_schema import schema_mapping, build_composite_schema, batched_answer_key
 import json
+import asyncio
+import random
+import time
 from config import Config
 from celery_app import celery
-import redis
-from llama_index.llms.nvidia import NVIDIA
-from llama_index.llms.mistralai import MistralAI
-from llama_index.llms.openai import OpenAI
+from result_stream import buffer_results, record_failed_requests
+from resources import get_llm_client, get_event_loop, get_session, get_redis
+from collections import OrderedDict
+import response_cache
+import run_spec
+import run_progress
+import token_usage
+import rate_limiter
+import answer_repair
+import provider_health
+from celery.utils.time import get_exponential_backoff_interval
 from llama_index.core.llms import ChatMessage, MessageRole
 
-@celery.task
-def query_LLM(messages: str, schema: str, user_id: int, profile_id: int, query_template_id: int, query_text: str, project_survey_id: int, model: str, llm_id: int, api_key: str, summary: str, query:str, survey_description:str, survey_context:str):
-    messages_obj = json.loads(messages)
-    schema_class = schema_mapping.get(schema)
-    
+# Bump when the summary format changes so stored summaries get regenerated
+SUMMARY_VERSION = 1
+SUMMARY_COLUMNS = ('summary', 'summary_version', 'summary_age')
+# Rate limiter waits an async request sits out before it is handed back to query_LLM
+ASYNC_THROTTLE_ATTEMPTS = 20
+# Profile summaries kept per worker process for the runs it is answering
+PROFILE_CACHE_SIZE = getattr(Config, 'WORKER_PROFILE_CACHE_SIZE', 5000)
+# Retries after transient provider errors, with exponential backoff
+TRANSIENT_MAX_RETRIES = getattr(Config, 'LLM_TRANSIENT_MAX_RETRIES', 5)
+# Answers that could not be repaired are asked again a few times, without the backoff of provider errors
+INVALID_ANSWER_MAX_RETRIES = getattr(Config, 'LLM_INVALID_ANSWER_MAX_RETRIES', 2)
+INVALID_ANSWER_RETRY_DELAY = 1
+
+_profile_cache = OrderedDict()  # (run_id, profile_id) -> (summary, population tag)
+
+def _build_chat_messages(messages_obj, summary: str, survey_description: str, survey_context: str, query: str):
+    """Fill the population prompt template and return the chat messages sent to the LLM."""
     system_prompt = next(item["content"] for item in messages_obj if item["role"] == "system").format(summary=summary)
     assistant_prompt = next(item["content"] for item in messages_obj if item["role"] == "assistant"). format(description=survey_description, context=survey_context)
     user_prompt = next(item["content"] for item in messages_obj if item["role"] == "user").format(query=query)
-    messages = [ChatMessage(role=MessageRole.SYSTEM, content=(system_prompt)), ChatMessage(role=MessageRole.ASSISTANT, content=(assistant_prompt)), ChatMessage(role=MessageRole.USER, content=(user_prompt), )]
-       
-    if llm_id==0:
-        LLM = NVIDIA(api_key=api_key, model=model, temperature=1)  
-    elif llm_id==1:
-        LLM = MistralAI(api_key=api_key, model=model, temperature=1)  
-    elif llm_id==2:
-        LLM = OpenAI(api_key=api_key, model=model, temperature=1) 
-
-    LLM = LLM.as_structured_llm (output_cls=schema_class)
-    prompt_str = LLM.messages_to_prompt(messages)
-    content = str(LLM.complete(prompt_str)).lower()    
-        
-    # token counters - to be implemented later    
-    prompt_tokens =0
-    completion_tokens =0
+    return [ChatMessage(role=MessageRole.SYSTEM, content=(system_prompt)), ChatMessage(role=MessageRole.ASSISTANT, content=(assistant_prompt)), ChatMessage(role=MessageRole.USER, content=(user_prompt), )]
+
+
+def _format_batched_query(questions) -> str:
+    """Render all survey questions as one query, each labelled with the key its answer must be returned under."""
+    lines = ["Answer each of the following survey questions. Return every answer under the key shown before the question."]
+    for question in questions:
+        lines.append(f"{batched_answer_key(question['query_template_id'])}: {question['query_text']}")
+    return "\n".join(lines)
+
+
+def _prepare_structured_call(messages: str, schema_class, model: str, llm_id: int, api_key: str, summary: str, query: str, survey_description: str, survey_context: str):
+    """Return the structured LLM wrapper and the rendered prompt for one query."""
+    messages_obj = json.loads(messages)
+    chat_messages = _build_chat_messages(messages_obj, summary, survey_description, survey_context, query)
+    LLM = get_llm_client(llm_id, model, api_key).as_structured_llm(output_cls=schema_class)
+    return LLM, LLM.messages_to_prompt(chat_messages)
+
+
+def _record_failed_call(llm_id: int, model: str, e: Exception, latency: float):
+    """Feed a failed call into the provider's health: answers that failed to parse still show the provider is up."""
+    kind = answer_repair.classify_error(e)
+    if kind != answer_repair.PERMANENT:
+        provider_health.record_call(llm_id, model, kind == answer_repair.INVALID_ANSWER, latency)
+
+
+def _call_provider(call, llm_id: int, model: str, api_key: str):
+    """
+    Run a provider call through the shared rate limiter, feeding 429s and successes back into it,
+    and its outcome and latency into the provider's circuit breaker.
+    """
+    started = time.monotonic()
+    try:
+        response = call()
+    except Exception as e:
+        if rate_limiter.is_rate_limit_error(e):
+            pause = rate_limiter.record_throttle(llm_id, model, api_key, rate_limiter.retry_after_from_error(e))
+            raise rate_limiter.RateLimitExceeded(pause) from e
+        _record_failed_call(llm_id, model, e, time.monotonic() - started)
+        raise
+    provider_health.record_call(llm_id, model, True, time.monotonic() - started)
+    rate_limiter.record_success(llm_id, model, api_key)
+    return response
+
+
+def _unparsed_output(e):
+    """Raw output of a structured call whose answer failed to parse or validate; any other error is re-raised."""
+    if answer_repair.classify_error(e) != answer_repair.INVALID_ANSWER:
+        raise e
+    raw = answer_repair.raw_output_from_error(e)
+    if raw is None:
+        raise answer_repair.InvalidAnswer(f"Unparseable structured output: {e}") from e
+    return raw
+
+
+def _complete(LLM, prompt_str: str, llm_id: int, model: str, api_key: str, schema: str, repair):
+    """
+    Run the structured completion, serving it from the response cache when enabled.
+    Output that failed to parse or validate goes through `repair`, which fixes schema violations locally and raises
+    answer_repair.InvalidAnswer if it cannot; valid output is kept as given.
+    Returns (content, prompt_tokens, completion_tokens); cached answers cost no provider tokens.
+    Raises rate_limiter.RateLimitExceeded when the provider quota requires waiting.
+    """
+    key = response_cache.cache_key(llm_id, model, schema, prompt_str) if response_cache.is_enabled() else None
+    if key:
+        content = response_cache.lookup(key)
+        if content is not None:
+            return content, 0, 0
+    rate_limiter.acquire(llm_id, model, api_key)
+    with token_usage.capture() as captured:
+        try:
+            response = _call_provider(lambda: LLM.complete(prompt_str), llm_id, model, api_key)
+            content = str(response)
+        except Exception as e:
+            response, content = None, repair(_unparsed_output(e))
+    if key:
+        response_cache.store(key, content)
+    return (content,) + token_usage.count_tokens(response, prompt_str, content, model, captured)
+
+
+async def _acomplete(LLM, prompt_str: str, llm_id: int, model: str, api_key: str, schema: str, repair):
+    """Async counterpart of _complete; waits for the shared rate limiter without blocking the event loop."""
+    key = response_cache.cache_key(llm_id, model, schema, prompt_str) if response_cache.is_enabled() else None
+    if key:
+        content = response_cache.lookup(key)
+        if content is not None:
+            return content, 0, 0
+    for _ in range(ASYNC_THROTTLE_ATTEMPTS):
+        wait = rate_limiter.try_acquire(llm_id, model, api_key)
+        if wait > 0:
+            await asyncio.sleep(wait + random.uniform(0, 0.5))
+            continue
+        with token_usage.capture() as captured:
+            try:
+                response = await _call_provider_async(LLM.acomplete(prompt_str), llm_id, model, api_key)
+                content = str(response)
+            except rate_limiter.RateLimitExceeded as e:
+                await asyncio.sleep(e.retry_after + random.uniform(0, 0.5))
+                continue
+            except Exception as e:
+                response, content = None, repair(_unparsed_output(e))
+        if key:
+            response_cache.store(key, content)
+        return (content,) + token_usage.count_tokens(response, prompt_str, content, model, captured)
+    raise rate_limiter.RateLimitExceeded(rate_limiter.DEFAULT_THROTTLE_PAUSE)
+
+
+async def _call_provider_async(coroutine, llm_id: int, model: str, api_key: str):
+    """Async counterpart of _call_provider."""
+    started = time.monotonic()
+    try:
+        response = await coroutine
+    except Exception as e:
+        if rate_limiter.is_rate_limit_error(e):
+            pause = rate_limiter.record_throttle(llm_id, model, api_key, rate_limiter.retry_after_from_error(e))
+            raise rate_limiter.RateLimitExceeded(pause) from e
+        _record_failed_call(llm_id, model, e, time.monotonic() - started)
+        raise
+    provider_health.record_call(llm_id, model, True, time.monotonic() - started)
+    rate_limiter.record_success(llm_id, model, api_key)
+    return response
+
+
+def _retry(task, kind: str, limit: int, countdown: float, exc=None):
+    """
+    Retry a query task, counting the attempt only against the budget of its kind (throttle, transient error,
+    invalid answer), so waiting for the rate limiter never uses up the retries meant for provider errors.
+    The counts travel with the task in its `attempts` argument. Returns the exception to raise.
+    """
+    kwargs = task.request.kwargs or {}
+    attempts = dict(kwargs.get('attempts') or {})
+    if attempts.get(kind, 0) >= limit:
+        print(f"{task.name} gave up after {limit} {kind} retries: {exc!r}")
+        return exc
+    attempts[kind] = attempts.get(kind, 0) + 1
+    return task.retry(kwargs=dict(kwargs, attempts=attempts), exc=exc, countdown=countdown)
+
+
+def _reschedule_throttled(task, e):
+    """Retry a task once the shared rate limiter allows it, with a little jitter to spread the workers."""
+    return _retry(task, 'throttle', rate_limiter.THROTTLE_MAX_RETRIES, e.retry_after + random.uniform(0, 1), e)
+
+
+def _retry_or_fail(task, e):
+    """
+    Retry a failed query task only when asking again can help: transient provider errors back off exponentially,
+    unrepairable answers are asked again soon a few times, and anything else fails the task at once.
+    """
+    kind = answer_repair.classify_error(e)
+    if kind == answer_repair.TRANSIENT:
+        retries = ((task.request.kwargs or {}).get('attempts') or {}).get(kind, 0)
+        countdown = get_exponential_backoff_interval(factor=1, retries=retries, maximum=task.retry_backoff_max, full_jitter=True)
+        return _retry(task, kind, TRANSIENT_MAX_RETRIES, countdown, e)
+    if kind == answer_repair.INVALID_ANSWER:
+        return _retry(task, kind, INVALID_ANSWER_MAX_RETRIES, INVALID_ANSWER_RETRY_DELAY, e)
+    print(f"{task.name} failed permanently, not retrying: {e!r}")
+    return e
+
+
+def _resolve_profiles(run_id: str, profile_ids):
+    """Summary and population tag of each profile, cached per run in this worker process."""
+    missing = [profile_id for profile_id in set(profile_ids) if (run_id, profile_id) not in _profile_cache]
+    if missing:
+        session = get_session()
+        try:
+            models = session.query(ProfileModel).options(
+                defer(ProfileModel.llm_persona_embeddings),
+                defer(ProfileModel.llm_typical_day_embeddings),
+                defer(ProfileModel.llm_persona_chunks),
+                defer(ProfileModel.llm_typical_day_chunks),
+            ).filter(ProfileModel.id.in_(missing)).all()
+            for model in models:
+                _profile_cache[(run_id, model.id)] = (Profile.from_model(session, model).summarize_attributes(), model.tags)
+        finally:
+            session.close()
+        while len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+    return {profile_id: _profile_cache[(run_id, profile_id)] for profile_id in profile_ids}
+
+
+def _resolve_request(project_survey_id: int, run_id: str, profile_id: int, query_template_ids, profiles: dict = None) -> dict:
+    """Expand the references carried by a query task into everything needed to build the prompt."""
+    spec = run_spec.load_spec(project_survey_id, run_id)
+    summary, population_tag = (profiles or _resolve_profiles(run_id, [profile_id]))[profile_id]
+    return {
+        'messages': run_spec.messages_for(spec, population_tag),
+        'summary': summary,
+        'user_id': spec['user_id'],
+        'llm_id': spec['llm_id'],
+        'model': spec['model'],
+        'api_key': run_spec.resolve_api_key(spec['llm_id']),
+        'survey_description': spec['survey_description'],
+        'survey_context': spec['survey_context'],
+        'questions': [dict(run_spec.question(spec, query_template_id), query_template_id=query_template_id) for query_template_id in query_template_ids],
+    }
+
+
+def _is_cancelled(project_survey_id: int, run_id: str) -> bool:
+    """Tasks of a cancelled or superseded run are dropped without calling the provider."""
+    if run_progress.is_cancelled(get_redis(), project_survey_id, run_id):
+        print(f"Skipping task of cancelled or superseded run {run_id} (project survey {project_survey_id})")
+        return True
+    return False
+
+
+@celery.task(bind=True)
+def query_LLM(self, project_survey_id: int, run_id: str, profile_id: int, query_template_id: int, attempts: dict = None):
+    if _is_cancelled(project_survey_id, run_id):
+        return None
+    try:
+        # While the provider's breaker is open the query goes to its fallback LLM
+        request = provider_health.route(_resolve_request(project_survey_id, run_id, profile_id, [query_template_id]))
+        question = request['questions'][0]
+        schema = question['schema']
+        schema_class = schema_mapping.get(schema)
+
+        LLM, prompt_str = _prepare_structured_call(request['messages'], schema_class, request['model'], request['llm_id'], request['api_key'], request['summary'], question['query_text'], request['survey_description'], request['survey_context'])
+        repair = lambda content: answer_repair.repair(content, schema, question['query_text'])
+        content, prompt_tokens, completion_tokens = _complete(LLM, prompt_str, request['llm_id'], request['model'], request['api_key'], schema, repair)
+    except rate_limiter.RateLimitExceeded as e:
+        raise _reschedule_throttled(self, e)
+    except Exception as e:
+        raise _retry_or_fail(self, e)
+    content = content.lower()
+
+    result = (content, prompt_tokens, completion_tokens, request['user_id'], profile_id, query_template_id, question['query_text'], project_survey_id, request['model'])
+
+    # After task completion, buffer the result for the writer task and update progress in Redis
+    buffer_results(project_survey_id, run_id, [result])
+
+    return result
 
-    # After task completion, update progress in Redis
-    r = redis.Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
-    r.incr(f"survey_completed_tasks_{project_survey_id}")
-    
-    return content, prompt_tokens, completion_tokens, user_id, profile_id, query_template_id, query_text, project_survey_id
+
+def _async_concurrency(llm_id: int) -> int:
+    """Maximum number of in-flight completions per provider within one worker process."""
+    limits = getattr(Config, 'LLM_ASYNC_CONCURRENCY', {0: 16, 1: 8, 2: 16})
+    return limits.get(llm_id, 8)
+
+
+async def _aquery_LLM(reference: dict, request: dict, semaphores: dict):
+    """Async counterpart of query_LLM for a single request, already resolved from its query_LLM references."""
+    request = provider_health.route(request)
+    question = request['questions'][0]
+    semaphore = semaphores.setdefault(request['llm_id'], asyncio.Semaphore(_async_concurrency(request['llm_id'])))
+    async with semaphore:
+        LLM, prompt_str = _prepare_structured_call(
+            request['messages'], schema_mapping.get(question['schema']), request['model'], request['llm_id'], request['api_key'],
+            request['summary'], question['query_text'], request['survey_description'], request['survey_context']
+        )
+        repair = lambda content: answer_repair.repair(content, question['schema'], question['query_text'])
+        content, prompt_tokens, completion_tokens = await _acomplete(LLM, prompt_str, request['llm_id'], request['model'], request['api_key'], question['schema'], repair)
+        content = content.lower()
+
+    result = (content, prompt_tokens, completion_tokens, request['user_id'], reference['profile_id'], reference['query_template_id'], question['query_text'], reference['project_survey_id'], request['model'])
+    buffer_results(reference['project_survey_id'], reference['run_id'], [result])
+    return result
+
+
+async def _aquery_many(references: list, requests: list):
+    semaphores = {}
+    return await asyncio.gather(*[_aquery_LLM(reference, request, semaphores) for reference, request in zip(references, requests)], return_exceptions=True)
+
+
+@celery.task(bind=True)
+def query_LLM_many(self, requests: list):
+    """
+    Run many query_LLM requests (dicts of query_LLM keyword arguments) concurrently on this worker's event loop,
+    limited per provider. Requests that failed with a retryable error are re-dispatched as individual query_LLM tasks
+    so they keep the normal retry policy; permanent failures are counted at once. Returns the result tuples of the successful requests.
+    """
+    requests = [request for request in requests if not _is_cancelled(request['project_survey_id'], request['run_id'])]
+    if not requests:
+        return []
+    # Resolve the profiles of the whole chunk with one query
+    profiles = {}
+    for run_id in {request['run_id'] for request in requests}:
+        profiles[run_id] = _resolve_profiles(run_id, [request['profile_id'] for request in requests if request['run_id'] == run_id])
+    resolved = [
+        _resolve_request(request['project_survey_id'], request['run_id'], request['profile_id'], [request['query_template_id']], profiles[request['run_id']])
+        for request in requests
+    ]
+    outcomes = get_event_loop().run_until_complete(_aquery_many(requests, resolved))
+
+    results, failed = [], []
+    for request, outcome in zip(requests, outcomes):
+        if isinstance(outcome, BaseException):
+            print(f"Async query failed for profile {request['profile_id']}, template {request['query_template_id']}: {outcome}")
+            if answer_repair.classify_error(outcome) == answer_repair.PERMANENT:
+                failed.append(request)
+            else:
+                # Stay on the run's queue
+                query_LLM.apply_async(kwargs=request, queue=(self.request.delivery_info or {}).get('routing_key'))
+        else:
+            results.append(outcome)
+    if failed:
+        record_failed_requests(failed)
+    return results
+
+
+@celery.task(bind=True)
+def query_LLM_batch(self, project_survey_id: int, run_id: str, profile_id: int, query_template_ids: list, attempts: dict = None):
+    """
+    Answer all questions of a survey for one profile with a single structured LLM call.
+    Returns one result tuple per question, in the same layout as query_LLM.
+    `attempts` counts the retries of each kind so far (see _retry).
+    """
+    if _is_cancelled(project_survey_id, run_id):
+        return []
+    try:
+        request = provider_health.route(_resolve_request(project_survey_id, run_id, profile_id, query_template_ids))
+        questions = request['questions']
+        schema_class = build_composite_schema(
+            [(batched_answer_key(question['query_template_id']), question['schema']) for question in questions]
+        )
+
+        LLM, prompt_str = _prepare_structured_call(request['messages'], schema_class, request['model'], request['llm_id'], request['api_key'], request['summary'], _format_batched_query(questions), request['survey_description'], request['survey_context'])
+        composite_schema = json.dumps([question['schema'] for question in questions])
+        repair = lambda content: answer_repair.repair_batch(content, questions, batched_answer_key)
+        content, prompt_tokens, completion_tokens = _complete(LLM, prompt_str, request['llm_id'], request['model'], request['api_key'], composite_schema, repair)
+        answers = schema_class.model_validate_json(content)
+    except rate_limiter.RateLimitExceeded as e:
+        raise _reschedule_throttled(self, e)
+    except Exception as e:
+        raise _retry_or_fail(self, e)
+
+    # The tokens of the single call are shared across the questions it answered
+    prompt_shares = token_usage.split_tokens(prompt_tokens, len(questions))
+    completion_shares = token_usage.split_tokens(completion_tokens, len(questions))
+
+    results = []
+    for index, question in enumerate(questions):
+        # Split the composite answer back into the per-question format produced by query_LLM
+        content = getattr(answers, batched_answer_key(question['query_template_id'])).model_dump_json().lower()
+        results.append((content, prompt_shares[index], completion_shares[index], request['user_id'], profile_id, question['query_template_id'], question['query_text'], project_survey_id, request['model']))
+
+    # After task completion, buffer the results for the writer task and update progress in Redis
+    buffer_results(project_survey_id, run_id, results)
+
+    return results
+
+
+@dataclass
+class SurveyRunContext:
+    """
+    Data that is constant for a whole survey run (user LLM settings and population prompt templates),
+    fetched once and published as the run spec shared by every task of the run.
+    """
+    user_id: int
+    llm_id: int
+    model: str
+    prompt_messages: dict  # population tag -> serialized prompt template
+
+    @classmethod
+    def load(cls, session: Session, user_id: int, population_tags):
+        """Prefetch the user's LLM settings and the prompt templates of the given population tags."""
+        user = session.query(User).get(user_id)
+        llm = session.query(LLM).get(user.llm_id)
+        prompt_messages = {}
+        for population in session.query(Population).filter(Population.tag.in_(set(population_tags))).order_by(Population.id):
+            if population.prompt_template and population.tag not in prompt_messages:
+                prompt_messages[population.tag] = json.dumps(population.prompt_template)
+        return cls(user_id=user_id, llm_id=user.llm_id, model=llm.settings, prompt_messages=prompt_messages)
 
 
 @dataclass
@@ -75,6 +437,9 @@ class Profile:
     hobbies: Optional[str] = None
     llm_persona: Optional[str] = None
     llm_typical_day: Optional[str] = None
+    summary: Optional[str] = None
+    summary_age: Optional[int] = None
+    tags: Optional[str] = None
 
     def save_to_db(self) -> int:
         """Save the profile to the database."""
@@ -114,13 +479,22 @@ class Profile:
         
         return ", ".join(f"{traits[i]}={levels[int(digit)]}" for i, digit in enumerate(ocean_code_str))
 
-    def summarize_attributes(self) -> str:
-        """Summarize profile attributes into a string."""
+    @staticmethod
+    def current_age(birth_date) -> int:
         current_date = datetime.now()
-        age = current_date.year - self.birth_date.year - (
-            (current_date.month, current_date.day) < (self.birth_date.month, self.birth_date.day)
+        return current_date.year - birth_date.year - (
+            (current_date.month, current_date.day) < (birth_date.month, birth_date.day)
         )
 
+    def summarize_attributes(self) -> str:
+        """Summarize profile attributes into a string, reusing the materialized summary while it is current."""
+        age = self.current_age(self.birth_date)
+        if self.summary is not None and self.summary_age == age:
+            return self.summary
+        return self._build_summary(age)
+
+    def _build_summary(self, age: int) -> str:
+        """Render the profile summary used in the system prompt."""
         summary = (
             f"Gender: {self.gender}\n"
             f"Birth Date: {self.birth_date}\n"
@@ -166,41 +540,35 @@ class Profile:
             print(f"No prompt_template found for population tag: {population_tag}")
             return None
 
-    def enqueue_query(self, user_id: int, profile_id: int, query: str, schema: str, query_template_id: int, project_survey_id: int, survey_description:str, survey_context:str) -> str:
-        # Fetch the profile's population tag
-        population_tag = self.session.query(ProfileModel.tags).filter_by(id=profile_id).scalar()
-        
-        # Fetch the prompt template from the populations table
-        prompt_template = self.get_population_prompt_template(population_tag)
-
-        # Get user's LLM settings
-        user = self.session.query(User).get(user_id)
-        llm = self.session.query(LLM).get(user.llm_id)
-        model = llm.settings
-        
-        # summarize attributes
-        summary = self.summarize_attributes()
-               
+    @staticmethod
+    def enqueue_query(profile_id: int, query_template_id: int, project_survey_id: int, run_id: str):
+        """
+        Create the task signature answering one query template for a profile.
+        The task only carries references; the prompt is resolved by the worker from the run spec.
+        """
         task_signature = query_LLM.s(
-            json.dumps(prompt_template),  
-            str(schema),
-            user_id,
-            profile_id,
-            query_template_id,
-            query,
-            project_survey_id,
-            model,          
-            user.llm_id,
-            llm.api_key,
-            summary,
-            query,
-            survey_description, 
-            survey_context
+            project_survey_id=project_survey_id,
+            run_id=run_id,
+            profile_id=profile_id,
+            query_template_id=query_template_id
         )
         print(f"Task signature created for query template id: {query_template_id}")
 
         return task_signature
 
+    @staticmethod
+    def enqueue_batch_query(profile_id: int, query_template_ids, project_survey_id: int, run_id: str):
+        """Create a single task signature answering all given query templates of a survey for a profile."""
+        task_signature = query_LLM_batch.s(
+            project_survey_id=project_survey_id,
+            run_id=run_id,
+            profile_id=profile_id,
+            query_template_ids=list(query_template_ids)
+        )
+        print(f"Batched task signature created for {len(query_template_ids)} query templates")
+
+        return task_signature
+
 
     def _log_interaction(self, user_id: int, profile_id: int, query_text: str, answer_text: str, template_id: int, cost: int, timestamp=None) -> None:
         """Private method to log an interaction into the interactions table."""
@@ -247,8 +615,31 @@ class Profile:
             personal_values=model.personal_values,
             hobbies=model.hobbies,
             llm_persona=model.llm_persona,
-            llm_typical_day=model.llm_typical_day
+            llm_typical_day=model.llm_typical_day,
+            summary=model.summary if model.summary_version == SUMMARY_VERSION else None,
+            summary_age=model.summary_age,
+            tags=model.tags
         )
+
+    @classmethod
+    def materialize_summary(cls, model: ProfileModel, force: bool = False) -> bool:
+        """
+        Regenerate the stored summary of a ProfileModel when it is missing, outdated or the profile's age changed.
+        Returns True if the model was updated.
+        """
+        age = cls.current_age(model.birth_date)
+        if not force and model.summary is not None and model.summary_version == SUMMARY_VERSION and model.summary_age == age:
+            return False
+        try:
+            summary = cls.from_model(None, model)._build_summary(age)
+        except (ValueError, TypeError) as e:
+            # Incomplete profiles keep being summarized on demand
+            print(f"Could not materialize summary for profile {model.id}: {e}")
+            summary = None
+        model.summary = summary
+        model.summary_version = SUMMARY_VERSION if summary is not None else None
+        model.summary_age = age if summary is not None else None
+        return True
         
     @classmethod
     def from_id(cls, session: Session, profile_id: int):
@@ -257,3 +648,12 @@ class Profile:
         if profile_record:
             return cls.from_model(session, profile_record)
         return None
+
+
+@event.listens_for(ProfileModel, 'before_insert')
+@event.listens_for(ProfileModel, 'before_update')
+def _refresh_profile_summary(mapper, connection, target):
+    """Keep the materialized summary in sync whenever a profile's attributes are written."""
+    state = sa_inspect(target)
+    changed = any(attr.history.has_changes() for attr in state.attrs if attr.key not in SUMMARY_COLUMNS)
+    Profile.materialize_summary(target, force=changed)
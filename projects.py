@@ -9,7 +9,7 @@ This module handles all project-related operations including:
 - Progress tracking and result management
 """
 
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, Response, stream_with_context
 from markupsafe import Markup
 from flask_login import login_required, current_user
 from models import db, Project,  FilterModel, SurveyTemplate, ProjectSurvey, Population, ProfileView
@@ -18,8 +18,14 @@ from filter import Filter
 from forms import ProjectForm,  FilterForm
 from flask_wtf.csrf import CSRFProtect
 from sqlalchemy.orm import aliased
-from vector_utils import VectorSearch
-from survey import Survey, get_survey_progress
+from survey import get_survey_progress, is_survey_run_active, plan_survey_run, cancel_survey_run
+from token_usage import usage_report
+from run_progress import event_stream, plan_run as start_planning
+from resources import get_redis
+from scheduling import queue_depths
+from access_control import admin_required
+from provider_health import health_report
+import uuid
 
 
 # Blueprint for project-related routes
@@ -72,7 +78,9 @@ def project_dashboard(project_id):
         segment = db.session.query(FilterModel).filter_by(id=survey.segment_id).first()
         survey.template = db.session.query(SurveyTemplate.name).filter_by(id=survey.survey_template_id).scalar()
         survey.segment_alias = segment.alias if segment else None
-        survey.is_running = (survey.completion_percentage == 0)
+        survey.is_running = bool(is_survey_run_active(survey.id))
+        # A stopped run that did not answer every question can be completed without re-asking answered ones
+        survey.can_resume = (survey.completion_percentage is not None and survey.completion_percentage < 100 and not survey.is_running)
   
     completed_surveys = db.session.query(ProjectSurvey).filter(
         ProjectSurvey.project_id == project_id,
@@ -276,42 +284,10 @@ def run_survey(project_id, survey_id):
     # Step 1: Retrieve the project and the survey
     project = Project.query.filter_by(id=project_id, user_id=current_user.id).first_or_404()
     project_survey = ProjectSurvey.query.filter_by(id=survey_id, project_id=project_id).first_or_404()
+    # Resume keeps previous answers and only asks the missing ones
+    resume = request.form.get('resume') == '1' and project_survey.completion_percentage is not None
     
-    # Set the completion_percentage to 0 to indicate that survey is running
-    project_survey.completion_percentage = 0
-    db.session.commit()
-    
-    # Step 2: Get the filter associated with the survey
-    filter_model = FilterModel.query.filter_by(id=project_survey.segment_id).first_or_404()
-    applied_filter = Filter.from_model(filter_model)
-    
-    # Step 3: Get the survey template associated with the project survey
-    survey_template = SurveyTemplate.query.filter_by(id=project_survey.survey_template_id).first_or_404()
-    
-    # Step 4: Count respondents and calculate interactions
-    query = db.session.query(ProfileView)
-    query = query.filter(ProfileView.tags.contains(project.population.tag))
-    filtered_query = applied_filter.apply_filters(query)
-    
-    if filter_model.ai_filter:
-        # If there's an AI filter, check vector search results
-        vector_search = VectorSearch()
-        profile_ids = vector_search.find_similar_profiles_from_query(
-            query=filter_model.ai_filter,
-            base_query=filtered_query,
-            similarity_threshold=0.32 # this will be customizable in the future
-        )
-        if not profile_ids:
-            flash(f'No profiles match the AI filter criteria for survey "{project_survey.survey_alias}".', 'warning')
-            return redirect(url_for('projects_bp.project_dashboard', project_id=project_id))
-        filtered_query = filtered_query.filter(ProfileView.id.in_(profile_ids))
-    
-    # Add limit to the query before counting
-    limited_query = filtered_query.limit(project_survey.respondents)
-    respondents_count = limited_query.count()
-    interactions_count = respondents_count * len(survey_template.query_templates)
-    
-    # Step 5: Check subscription limits
+    # Step 2: Check subscription limits that do not depend on the respondents
     if not current_user.subscription or not current_user.subscription.is_active:
         flash("No active subscription found", 'warning')
         return redirect(url_for('projects_bp.project_dashboard', project_id=project_id))
@@ -321,24 +297,36 @@ def run_survey(project_id, survey_id):
         flash(f"Project limit exceeded. Maximum allowed: {current_user.subscription.max_projects}", 'warning')
         return redirect(url_for('projects_bp.project_dashboard', project_id=project_id))
     
-    if respondents_count > current_user.subscription.max_respondents_per_survey:
-        flash(f"Respondents per survey limit exceeded. Maximum allowed: {current_user.subscription.max_respondents_per_survey}", 'warning')
+    # Step 3: Hand respondent selection, credit checks and fan-out to the planner task.
+    # Its outcome (including a refused run) is pushed to the dashboard through the progress events.
+    # Queuing the run and checking that no other run is active is one atomic step, so a double submit starts one planner
+    run_id = uuid.uuid4().hex
+    if not start_planning(get_redis(), survey_id, run_id):
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': 'Survey is still running'}), 409
+        flash(f'Survey "{project_survey.survey_alias}" is still running.', 'warning')
         return redirect(url_for('projects_bp.project_dashboard', project_id=project_id))
+    plan_survey_run.apply_async(args=(survey_id,), kwargs={'resume': resume}, task_id=run_id)
     
-    if interactions_count > current_user.subscription.remaining_interactions:
-        flash(f"Insufficient interaction credits. Available: {current_user.subscription.remaining_interactions}", 'warning')
-        return redirect(url_for('projects_bp.project_dashboard', project_id=project_id))
-    
-    # Deduct interactions from remaining_interactions
-    current_user.subscription.remaining_interactions -= interactions_count
-    db.session.commit()
-    
-    # Step 6: Run the survey using the Survey class and applying the max_respondents limit
-    survey = Survey(applied_filter, db.session, survey_template, custom_parameters_dict={}, max_respondents=project_survey.respondents)
-    result = survey.run_survey(project_survey_id=survey_id)
+    # Step 4: Provide feedback and redirect to the project dashboard
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'run_id': run_id}), 202
+    flash(f'Survey "{project_survey.survey_alias}" has been {"resumed" if resume else "queued"}...', 'success')
+    return redirect(url_for('projects_bp.project_dashboard', project_id=project_id))
+
+
+@projects_bp.route('/project/<int:project_id>/cancel_survey/<int:survey_id>', methods=['POST'])
+@login_required
+def cancel_survey(project_id, survey_id):
+    """Stop a running survey, keeping the answers collected so far and refunding unused interactions."""
+    Project.query.filter_by(id=project_id, user_id=current_user.id).first_or_404()
+    project_survey = ProjectSurvey.query.filter_by(id=survey_id, project_id=project_id).first_or_404()
     
-    # Step 7: Provide feedback and redirect to the project dashboard
-    flash(f'Survey "{project_survey.survey_alias}" has been queued...', 'success')
+    refunded = cancel_survey_run(survey_id)
+    if refunded is None:
+        flash(f'Survey "{project_survey.survey_alias}" is not running.', 'warning')
+    else:
+        flash(f'Survey "{project_survey.survey_alias}" has been cancelled. {refunded} unused interactions were refunded.', 'success')
     return redirect(url_for('projects_bp.project_dashboard', project_id=project_id))
 
 
@@ -353,6 +341,45 @@ def survey_progress(project_survey_id):
     return jsonify({'progress': int(rounded_progress)})
     
         
+@projects_bp.route('/survey_queues', methods=['GET'])
+@admin_required
+def survey_queues():
+    """Number of survey tasks waiting in each scheduling queue (operators only)."""
+    return jsonify(queue_depths())
+
+
+@projects_bp.route('/llm_health', methods=['GET'])
+@admin_required
+def llm_health():
+    """Circuit breaker state, error rate and latency of the LLM providers used by survey tasks (operators only)."""
+    return jsonify(health_report())
+
+
+@projects_bp.route('/project/<int:project_id>/progress_events', methods=['GET'])
+@login_required
+def progress_events(project_id):
+    """Server-sent events with progress, throughput and ETA of every survey of the project."""
+    Project.query.filter_by(id=project_id, user_id=current_user.id).first_or_404()
+    survey_ids = [survey_id for survey_id, in db.session.query(ProjectSurvey.id).filter_by(project_id=project_id).all()]
+    # Release the database connection before holding the request open
+    db.session.remove()
+    return Response(stream_with_context(event_stream(survey_ids)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@projects_bp.route('/project/<int:project_id>/survey_usage/<int:survey_id>', methods=['GET'])
+@login_required
+def survey_usage(project_id, survey_id):
+    """Token usage of a project survey, aggregated per model."""
+    Project.query.filter_by(id=project_id, user_id=current_user.id).first_or_404()
+    project_survey = ProjectSurvey.query.filter_by(id=survey_id, project_id=project_id).first_or_404()
+    return jsonify({
+        'prompt_tokens': project_survey.prompt_tokens or 0,
+        'completion_tokens': project_survey.completion_tokens or 0,
+        'models': usage_report(db.session, project_survey_id=survey_id, user_id=current_user.id)
+    })
+
+
 @projects_bp.route('/project/<int:project_id>/available_results', methods=['GET'])
 @login_required
 def available_results(project_id):
@@ -0,0 +1,187 @@
+#provider_health.py
+
+"""
+Health tracking and circuit breakers for LLM providers.
+Every provider call records its outcome and latency in per-(provider, model) Redis buckets shared by all workers.
+When the error rate or the share of slow calls over the last window crosses its threshold the breaker opens:
+survey tasks are routed to the fallback LLM row configured for the provider (Config.LLM_FALLBACKS, none by
+default) instead of retrying against the failing one; without a fallback they wait for the breaker to close. After a cool-down a single probe call is let through; its success closes the
+breaker, its failure keeps it open for another cool-down.
+
+Config.LLM_CIRCUIT_BREAKER (all keys optional, see DEFAULT_SETTINGS):
+    window:            seconds of calls the error and slow call rates are computed over
+    min_calls:         calls needed in the window before the breaker may open
+    error_rate:        share of failed calls that opens the breaker
+    slow_call_seconds: calls slower than this count as slow
+    slow_call_rate:    share of slow calls that opens the breaker
+    open_seconds:      cool-down before a probe call is let through
+    probe_interval:    seconds between two probes while the breaker is half open
+"""
+
+import time
+from config import Config
+from resources import get_redis
+import rate_limiter
+import run_spec
+
+HEALTH_PREFIX = "llm_health"
+BREAKER_PREFIX = "llm_breaker"
+BUCKET_SECONDS = 10
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+DEFAULT_SETTINGS = {
+    'window': 60,
+    'min_calls': 20,
+    'error_rate': 0.5,
+    'slow_call_seconds': 30,
+    'slow_call_rate': 0.5,
+    'open_seconds': 30,
+    'probe_interval': 10,
+}
+
+# Fallback LLM row per provider (0 = NVIDIA, 1 = MistralAI, 2 = OpenAI), e.g. {0: 2, 1: 2}. Opt-in: answers would
+# come from another provider's model and the owner's prompts would be sent to it
+FALLBACKS = getattr(Config, 'LLM_FALLBACKS', {})
+
+
+class ProviderUnavailable(rate_limiter.RateLimitExceeded):
+    """The provider's breaker is open and no healthy fallback is configured; retry after `retry_after` seconds."""
+    def __init__(self, llm_id: int, model: str, retry_after: float):
+        super().__init__(retry_after)
+        self.args = (f"LLM provider {llm_id} ({model}) unavailable, retry in {retry_after:.1f}s",)
+
+
+def settings() -> dict:
+    return {**DEFAULT_SETTINGS, **getattr(Config, 'LLM_CIRCUIT_BREAKER', {})}
+
+
+def _bucket_key(llm_id, model, bucket):
+    return f"{HEALTH_PREFIX}:{llm_id}:{model}:{bucket}"
+
+def _breaker_key(llm_id, model):
+    return f"{BREAKER_PREFIX}:{llm_id}:{model}"
+
+def _probe_key(llm_id, model):
+    return f"{BREAKER_PREFIX}_probe:{llm_id}:{model}"
+
+
+def window_stats(r, llm_id, model, config=None):
+    """Calls, errors, slow calls and mean latency of a provider model over the last window."""
+    config = config or settings()
+    current = int(time.time() // BUCKET_SECONDS)
+    pipe = r.pipeline()
+    for bucket in range(current - config['window'] // BUCKET_SECONDS, current + 1):
+        pipe.hgetall(_bucket_key(llm_id, model, bucket))
+    stats = {'calls': 0, 'errors': 0, 'slow': 0, 'latency': 0.0}
+    for values in pipe.execute():
+        for field, value in values.items():
+            field = field.decode('utf-8')
+            stats[field] += float(value) if field == 'latency' else int(value)
+    stats['mean_latency'] = round(stats.pop('latency') / stats['calls'], 3) if stats['calls'] else None
+    return stats
+
+
+def _should_open(stats, config):
+    if stats['calls'] < config['min_calls']:
+        return None
+    if stats['errors'] >= config['error_rate'] * stats['calls']:
+        return f"{stats['errors']} of {stats['calls']} calls failed"
+    if stats['slow'] >= config['slow_call_rate'] * stats['calls']:
+        return f"{stats['slow']} of {stats['calls']} calls took over {config['slow_call_seconds']}s"
+    return None
+
+
+def _open(r, llm_id, model, reason, config):
+    now = time.time()
+    r.hset(_breaker_key(llm_id, model), mapping={'state': OPEN, 'opened_at': now, 'until': now + config['open_seconds'], 'reason': reason})
+    r.expire(_breaker_key(llm_id, model), 24 * 3600)
+    print(f"Circuit breaker opened for LLM provider {llm_id} ({model}): {reason}")
+
+
+def record_call(llm_id, model, ok: bool, latency: float):
+    """Record the outcome of a provider call and open or close the provider's breaker accordingly."""
+    config = settings()
+    r = get_redis()
+    key = _bucket_key(llm_id, model, int(time.time() // BUCKET_SECONDS))
+    slow = latency >= config['slow_call_seconds']
+    pipe = r.pipeline()
+    pipe.hincrby(key, 'calls', 1)
+    if not ok:
+        pipe.hincrby(key, 'errors', 1)
+    if slow:
+        pipe.hincrby(key, 'slow', 1)
+    pipe.hincrbyfloat(key, 'latency', latency)
+    pipe.expire(key, config['window'] + 2 * BUCKET_SECONDS)
+    pipe.hget(_breaker_key(llm_id, model), 'state')
+    state = pipe.execute()[-1]
+    state = state.decode('utf-8') if state else CLOSED
+
+    if state == HALF_OPEN:
+        if ok and not slow:
+            r.delete(_breaker_key(llm_id, model), _probe_key(llm_id, model))
+            print(f"Circuit breaker closed for LLM provider {llm_id} ({model})")
+        else:
+            _open(r, llm_id, model, "probe call failed", config)
+    elif state == CLOSED and (not ok or slow):
+        reason = _should_open(window_stats(r, llm_id, model, config), config)
+        if reason:
+            _open(r, llm_id, model, reason, config)
+
+
+def allow(llm_id, model) -> bool:
+    """True if calls may be sent to the provider model: its breaker is closed, or this call is the half-open probe."""
+    r = get_redis()
+    state, until = r.hmget(_breaker_key(llm_id, model), 'state', 'until')
+    if state is None:
+        return True
+    if float(until or 0) > time.time():
+        return False
+    # Cool-down over: let one probe call through at a time
+    if r.set(_probe_key(llm_id, model), 1, nx=True, ex=settings()['probe_interval']):
+        r.hset(_breaker_key(llm_id, model), 'state', HALF_OPEN)
+        return True
+    return False
+
+
+def _retry_after(llm_id, model):
+    until = get_redis().hget(_breaker_key(llm_id, model), 'until')
+    return max(float(until or 0) - time.time(), 0) + 1
+
+
+def route(request: dict) -> dict:
+    """
+    Return the resolved query request (llm_id, model, api_key, ...) with the provider to call: its own,
+    or the configured fallback LLM row while its breaker is open. Raises ProviderUnavailable if neither can be used.
+    """
+    llm_id, model = request['llm_id'], request['model']
+    if allow(llm_id, model):
+        return request
+    fallback_id = FALLBACKS.get(llm_id)
+    if fallback_id is not None and fallback_id != llm_id:
+        fallback_model, fallback_api_key = run_spec.resolve_provider(fallback_id)
+        if fallback_model and allow(fallback_id, fallback_model):
+            return dict(request, llm_id=fallback_id, model=fallback_model, api_key=fallback_api_key)
+    raise ProviderUnavailable(llm_id, model, _retry_after(llm_id, model))
+
+
+def health_report(llm_ids=None):
+    """Breaker state and window statistics of the provider models seen recently."""
+    r = get_redis()
+    models = set()
+    for key in r.scan_iter(match=f"{HEALTH_PREFIX}:*", count=500):
+        llm_id, model = key.decode('utf-8')[len(HEALTH_PREFIX) + 1:].rsplit(':', 1)[0].split(':', 1)
+        if llm_ids is None or int(llm_id) in llm_ids:
+            models.add((int(llm_id), model))
+    report = []
+    for llm_id, model in sorted(models):
+        state, reason = r.hmget(_breaker_key(llm_id, model), 'state', 'reason')
+        report.append({
+            'llm_id': llm_id,
+            'model': model,
+            'state': state.decode('utf-8') if state else CLOSED,
+            'reason': reason.decode('utf-8') if reason else None,
+            'fallback_llm_id': FALLBACKS.get(llm_id),
+            **window_stats(r, llm_id, model),
+        })
+    return report
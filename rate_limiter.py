@@ -0,0 +1,181 @@
+#rate_limiter.py
+
+"""
+Cluster-wide adaptive rate limiter for LLM providers.
+A token bucket per (provider, model, api key) lives in Redis and is shared by every worker, so
+throughput scales with the number of workers up to the provider limit instead of a static per-worker rate.
+The bucket rate backs off multiplicatively on 429 responses (honouring Retry-After) and recovers additively
+on successful calls.
+"""
+
+import hashlib
+import re
+import time
+from config import Config
+from resources import get_redis
+
+KEY_PREFIX = "llm_rate_limit"
+
+# Requests per minute allowed per provider (0 = NVIDIA, 1 = MistralAI, 2 = OpenAI); the mock's is mock_llm.RATE_LIMIT
+DEFAULT_RATE_LIMITS = {0: 40, 1: 60, 2: 500}
+# Rate never drops below this fraction of the configured limit
+MIN_RATE_FRACTION = 0.05
+# Seconds of traffic a full bucket may burst
+BURST_SECONDS = 5
+# Pause applied on a 429 without a Retry-After header
+DEFAULT_THROTTLE_PAUSE = 10
+# Waits up to this many seconds are slept in place instead of rescheduling the task
+MAX_INLINE_WAIT = 2
+# Retry budget for tasks rescheduled because of throttling
+THROTTLE_MAX_RETRIES = getattr(Config, 'LLM_THROTTLE_MAX_RETRIES', 100)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call has to wait for the shared bucket; `retry_after` is the suggested delay in seconds."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"LLM rate limit reached, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+# Atomically refill the bucket and take one token. Returns 0 if granted, else the seconds to wait.
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate', 'paused_until')
+local rate = tonumber(state[3]) or max_rate
+local capacity = math.max(1, rate * burst)
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+local paused_until = tonumber(state[4]) or 0
+if paused_until > now then
+    return tostring(paused_until - now)
+end
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+# Adjust the bucket rate: ARGV[2] = 'throttle' or 'success'
+_ADAPT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[3])
+local min_rate = tonumber(ARGV[4])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or max_rate
+if ARGV[2] == 'throttle' then
+    rate = math.max(min_rate, rate / 2)
+    redis.call('HSET', KEYS[1], 'rate', rate, 'tokens', 0, 'ts', now, 'paused_until', now + tonumber(ARGV[5]))
+elseif rate < max_rate then
+    rate = math.min(max_rate, rate + max_rate * 0.01)
+    redis.call('HSET', KEYS[1], 'rate', rate)
+end
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+
+def bucket_key(llm_id: int, model: str, api_key: str) -> str:
+    key_hash = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]
+    return f"{KEY_PREFIX}:{llm_id}:{model}:{key_hash}"
+
+
+def _max_rate(llm_id: int) -> float:
+    """Configured limit in requests per second."""
+    limits = getattr(Config, 'LLM_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+    if llm_id not in limits and llm_id not in DEFAULT_RATE_LIMITS:
+        # The mock provider is only loaded for load tests
+        from mock_llm import MOCK_LLM_ID, RATE_LIMIT
+        if llm_id == MOCK_LLM_ID:
+            return RATE_LIMIT / 60.0
+    return limits.get(llm_id, 20) / 60.0
+
+
+def try_acquire(llm_id: int, model: str, api_key: str) -> float:
+    """Take one request slot from the shared bucket. Returns 0 if granted, else the seconds to wait."""
+    r = get_redis()
+    return float(r.eval(_ACQUIRE_SCRIPT, 1, bucket_key(llm_id, model, api_key), time.time(), _max_rate(llm_id), BURST_SECONDS))
+
+
+def acquire(llm_id: int, model: str, api_key: str, max_wait: float = MAX_INLINE_WAIT):
+    """
+    Take one request slot, sleeping in place for short waits.
+    Raises RateLimitExceeded when the wait is longer than `max_wait`, so the caller can reschedule instead.
+    """
+    while True:
+        wait = try_acquire(llm_id, model, api_key)
+        if wait <= 0:
+            return
+        if wait > max_wait:
+            raise RateLimitExceeded(wait)
+        time.sleep(wait)
+
+
+def _adapt(llm_id: int, model: str, api_key: str, outcome: str, pause: float = 0):
+    max_rate = _max_rate(llm_id)
+    r = get_redis()
+    r.eval(_ADAPT_SCRIPT, 1, bucket_key(llm_id, model, api_key), time.time(), outcome, max_rate, max_rate * MIN_RATE_FRACTION, pause)
+
+
+def record_success(llm_id: int, model: str, api_key: str):
+    """Additive increase back towards the configured limit after a successful call."""
+    _adapt(llm_id, model, api_key, 'success')
+
+
+def record_throttle(llm_id: int, model: str, api_key: str, retry_after: float = None) -> float:
+    """Halve the shared rate and pause the bucket after a 429. Returns the pause in seconds."""
+    pause = retry_after if retry_after is not None else DEFAULT_THROTTLE_PAUSE
+    _adapt(llm_id, model, api_key, 'throttle', pause)
+    return pause
+
+
+def _response_headers(exc):
+    response = getattr(exc, 'response', None)
+    return getattr(response, 'headers', None) or {}
+
+
+# A 429 status quoted in an error message ('Error code: 429', 'HTTP 429', 'status_code=429'), not any '429' in it
+_STATUS_429 = re.compile(r'\b(?:status|http|error|code)[\w\s/.]{0,12}?[:= ]\s*429\b')
+# Durations like '20', '1.5s', '250ms', '1m30s' or '2h0m0s' (Go style, used by x-ratelimit-reset-* headers)
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)?')
+_UNIT_SECONDS = {'ms': 0.001, 'h': 3600, 'm': 60, 's': 1, None: 1}
+
+
+def is_rate_limit_error(exc) -> bool:
+    """True for provider errors signalling HTTP 429 / quota exhaustion."""
+    status = getattr(exc, 'status_code', None) or getattr(getattr(exc, 'response', None), 'status_code', None)
+    if status is not None:
+        return status == 429
+    message = str(exc).lower()
+    return bool(_STATUS_429.search(message)) or 'rate limit' in message or 'too many requests' in message
+
+
+def _parse_duration(value):
+    """Seconds of a duration header value, or None; HTTP dates in Retry-After are not supported."""
+    value = value.replace(' ', '')
+    parts = list(_DURATION.finditer(value))
+    if not parts or ''.join(part.group(0) for part in parts) != value:
+        return None
+    # A bare number is only valid on its own
+    if len(parts) > 1 and any(part.group(2) is None for part in parts):
+        return None
+    return sum(float(part.group(1)) * _UNIT_SECONDS[part.group(2)] for part in parts)
+
+
+def retry_after_from_error(exc):
+    """Delay requested by the provider through Retry-After or x-ratelimit-reset headers, if any."""
+    headers = _response_headers(exc)
+    for header in ('retry-after', 'x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        value = headers.get(header)
+        if value is None:
+            continue
+        seconds = _parse_duration(str(value).strip().lower())
+        if seconds is not None:
+            return seconds
+    return None
@@ -0,0 +1,176 @@
+#resources.py
+
+"""
+Per-process resource manager for Celery workers (also safe to use from the web process).
+Keeps one pooled SQLAlchemy engine, one Redis connection pool for commands and a separate one for the long-lived
+pub/sub connections of progress streams, LLM clients cached by (llm_id, model, api_key)
+and embedding clients cached by (model, api_key), so tasks reuse connections instead of paying setup and TLS handshakes.
+"""
+
+import asyncio
+import threading
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from celery.signals import worker_process_init, worker_process_shutdown
+from config import Config
+
+_lock = threading.Lock()
+_engine = None
+_session_factory = None
+_redis_pool = None
+_pubsub_pool = None
+_llm_clients = {}
+_embedding_clients = {}  # model -> (api_key, client)
+_event_loop = None
+
+
+def get_engine():
+    """Return the process-wide pooled engine."""
+    global _engine, _session_factory
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                _engine = create_engine(
+                    Config.SQLALCHEMY_DATABASE_URI,
+                    pool_pre_ping=True,
+                    pool_size=getattr(Config, 'WORKER_DB_POOL_SIZE', 5),
+                    max_overflow=getattr(Config, 'WORKER_DB_MAX_OVERFLOW', 10),
+                )
+                _session_factory = sessionmaker(bind=_engine)
+    return _engine
+
+
+def get_session():
+    """Open a new session bound to the pooled engine. The caller is responsible for closing it."""
+    get_engine()
+    return _session_factory()
+
+
+def get_redis():
+    """Return a Redis client backed by the shared connection pool."""
+    global _redis_pool
+    if _redis_pool is None:
+        with _lock:
+            if _redis_pool is None:
+                _redis_pool = redis.ConnectionPool(
+                    host=Config.REDIS_HOST,
+                    port=Config.REDIS_PORT,
+                    db=Config.REDIS_DB,
+                    max_connections=getattr(Config, 'REDIS_MAX_CONNECTIONS', 50),
+                )
+    return redis.Redis(connection_pool=_redis_pool)
+
+
+def get_pubsub_redis():
+    """
+    Return a Redis client for pub/sub subscriptions, backed by its own pool.
+    Every open progress stream holds one of its connections, so streams can never exhaust the shared pool; once
+    REDIS_PUBSUB_MAX_CONNECTIONS streams are open, subscribing raises redis.ConnectionError.
+    """
+    global _pubsub_pool
+    if _pubsub_pool is None:
+        with _lock:
+            if _pubsub_pool is None:
+                _pubsub_pool = redis.ConnectionPool(
+                    host=Config.REDIS_HOST,
+                    port=Config.REDIS_PORT,
+                    db=Config.REDIS_DB,
+                    max_connections=getattr(Config, 'REDIS_PUBSUB_MAX_CONNECTIONS', 100),
+                )
+    return redis.Redis(connection_pool=_pubsub_pool)
+
+
+def _create_llm_client(llm_id: int, model: str, api_key: str):
+    """Instantiate the LLM client for a provider (0 = NVIDIA, 1 = MistralAI, 2 = OpenAI, MOCK_LLM_ID = local mock)."""
+    if llm_id==0:
+        from llama_index.llms.nvidia import NVIDIA
+        return NVIDIA(api_key=api_key, model=model, temperature=1)
+    elif llm_id==1:
+        from llama_index.llms.mistralai import MistralAI
+        return MistralAI(api_key=api_key, model=model, temperature=1)
+    elif llm_id==2:
+        from llama_index.llms.openai import OpenAI
+        return OpenAI(api_key=api_key, model=model, temperature=1)
+    # The mock provider is only loaded for load tests
+    from mock_llm import MOCK_LLM_ID, MockLLM
+    if llm_id==MOCK_LLM_ID:
+        return MockLLM(model=model)
+    raise ValueError(f"Unknown llm_id: {llm_id}")
+
+
+def get_llm_client(llm_id: int, model: str, api_key: str):
+    """Return the cached LLM client for (llm_id, model, api_key), creating it on first use."""
+    key = (llm_id, model, api_key)
+    client = _llm_clients.get(key)
+    if client is None:
+        with _lock:
+            client = _llm_clients.get(key)
+            if client is None:
+                client = _create_llm_client(llm_id, model, api_key)
+                _llm_clients[key] = client
+    return client
+
+
+def get_embedding_client(model: str, api_key: str):
+    """
+    Return the cached NVIDIA embedding client of a model, creating it on first use.
+    A client built with a previous API key is replaced, so a rotated key takes effect on the next call.
+    """
+    cached = _embedding_clients.get(model)
+    if cached is None or cached[0] != api_key:
+        with _lock:
+            cached = _embedding_clients.get(model)
+            if cached is None or cached[0] != api_key:
+                from llama_index.embeddings.nvidia import NVIDIAEmbedding
+                cached = (api_key, NVIDIAEmbedding(model=model, api_key=api_key))
+                _embedding_clients[model] = cached
+    return cached[1]
+
+
+def get_event_loop():
+    """
+    Return the process-wide event loop used for async LLM calls.
+    Cached clients keep async HTTP sessions bound to this loop, so it lives as long as the process.
+    """
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop
+
+
+def dispose(close: bool = True):
+    """
+    Release all pooled connections and cached clients held by this process.
+    With close=False, connections inherited from a parent process are dropped without being closed.
+    """
+    global _engine, _session_factory, _redis_pool, _pubsub_pool, _event_loop
+    with _lock:
+        if _engine is not None:
+            _engine.dispose(close=close)
+        if _redis_pool is not None and close:
+            _redis_pool.disconnect()
+        if _pubsub_pool is not None and close:
+            _pubsub_pool.disconnect()
+        _engine = None
+        _session_factory = None
+        if _event_loop is not None and close and not _event_loop.is_running():
+            _event_loop.close()
+        _redis_pool = None
+        _pubsub_pool = None
+        _event_loop = None
+        _llm_clients.clear()
+        _embedding_clients.clear()
+
+
+@worker_process_init.connect
+def init_worker_resources(**kwargs):
+    """Start each worker process with fresh pools; connections must never be shared across processes."""
+    dispose(close=False)
+    get_engine()
+    get_redis()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_resources(**kwargs):
+    dispose()
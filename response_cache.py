@@ -0,0 +1,72 @@
+#response_cache.py
+
+"""
+Opt-in cache of LLM survey answers stored in Redis.
+Answers are keyed by a hash of everything that shapes the provider call (provider, model, answer schema
+and the fully rendered prompt, which contains the profile summary, question and survey context),
+so re-running an unchanged survey does not pay for the same completions again.
+Entries expire after a TTL and the oldest entries are evicted once the cache exceeds its size limit.
+"""
+
+import hashlib
+import json
+import time
+from config import Config
+from resources import get_redis
+
+CACHE_PREFIX = "llm_response_cache"
+INDEX_KEY = f"{CACHE_PREFIX}:index"
+HITS_KEY = f"{CACHE_PREFIX}:hits"
+MISSES_KEY = f"{CACHE_PREFIX}:misses"
+
+CACHE_TTL = getattr(Config, 'LLM_RESPONSE_CACHE_TTL', 7 * 24 * 3600)
+CACHE_MAX_ENTRIES = getattr(Config, 'LLM_RESPONSE_CACHE_MAX_ENTRIES', 500000)
+
+
+def is_enabled() -> bool:
+    return getattr(Config, 'LLM_RESPONSE_CACHE', False)
+
+
+def cache_key(llm_id: int, model: str, schema: str, prompt: str) -> str:
+    """Deterministic key for one provider call."""
+    payload = json.dumps([llm_id, model, schema, prompt], ensure_ascii=False)
+    return f"{CACHE_PREFIX}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+def lookup(key: str):
+    """Return the cached answer for `key`, or None on a miss. Updates the hit/miss counters."""
+    r = get_redis()
+    content = r.get(key)
+    r.incr(HITS_KEY if content is not None else MISSES_KEY)
+    return content.decode('utf-8') if content is not None else None
+
+
+def store(key: str, content: str):
+    """Cache an answer and evict expired or excess entries."""
+    now = time.time()
+    r = get_redis()
+    pipe = r.pipeline()
+    pipe.set(key, content, ex=CACHE_TTL)
+    pipe.zadd(INDEX_KEY, {key: now})
+    pipe.zremrangebyscore(INDEX_KEY, '-inf', now - CACHE_TTL)
+    pipe.zcard(INDEX_KEY)
+    size = pipe.execute()[-1]
+
+    if size > CACHE_MAX_ENTRIES:
+        # Size-based eviction: drop the oldest entries first
+        evicted = [member for member, _ in r.zpopmin(INDEX_KEY, size - CACHE_MAX_ENTRIES)]
+        if evicted:
+            r.delete(*evicted)
+
+
+def cache_stats() -> dict:
+    """Hit/miss counters and current size of the response cache."""
+    r = get_redis()
+    hits = int(r.get(HITS_KEY) or 0)
+    misses = int(r.get(MISSES_KEY) or 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0,
+        'entries': r.zcard(INDEX_KEY),
+    }
@@ -0,0 +1,153 @@
+#result_stream.py
+
+"""
+Streaming persistence of survey results.
+Completed LLM answers are buffered in a Redis stream per project survey and flushed to the
+interactions table in bounded batches by the survey.flush_survey_results writer task.
+The writer checkpoints the last persisted stream entry so partial results survive failures.
+"""
+
+import inspect
+import json
+from celery.signals import task_failure
+from config import Config
+from celery_app import celery
+from resources import get_redis
+import run_progress
+
+# Maximum number of results written to the database in one transaction
+FLUSH_BATCH_SIZE = getattr(Config, 'SURVEY_RESULTS_FLUSH_BATCH', 500)
+# Seconds a writer may hold the per-survey lock before it is considered dead
+WRITER_LOCK_TIMEOUT = 300
+
+SURVEY_QUERY_TASKS = ('profile.query_LLM', 'profile.query_LLM_batch', 'profile.query_LLM_many')
+
+
+def stream_key(project_survey_id):
+    return f"survey_results_{project_survey_id}"
+
+def checkpoint_key(project_survey_id):
+    return f"survey_results_checkpoint_{project_survey_id}"
+
+def writer_lock_key(project_survey_id):
+    return f"survey_results_writer_lock_{project_survey_id}"
+
+def flush_scheduled_key(project_survey_id):
+    return f"survey_results_flush_scheduled_{project_survey_id}"
+
+
+def reset_stream(r, project_survey_id):
+    """Drop buffered results and checkpoints left over from a previous run."""
+    r.delete(
+        stream_key(project_survey_id),
+        checkpoint_key(project_survey_id),
+        writer_lock_key(project_survey_id),
+        flush_scheduled_key(project_survey_id),
+    )
+
+
+def is_run_finished(r, project_survey_id) -> bool:
+    """True once every task of the run has either produced a result or failed permanently."""
+    return run_progress.is_finished(run_progress.read_counters(r, project_survey_id))
+
+
+def schedule_flush(r, project_survey_id):
+    """Enqueue the writer task unless one is already scheduled for this survey."""
+    if r.set(flush_scheduled_key(project_survey_id), 1, nx=True, ex=WRITER_LOCK_TIMEOUT):
+        celery.signature('survey.flush_survey_results', args=(project_survey_id,)).delay()
+
+
+# Append results (ARGV[3..]) tagged with their run id (ARGV[1]) and count them, only while that run is the
+# current run of the progress hash (KEYS[1]); returns the stream (KEYS[2]) length, or -1 for a superseded run
+_BUFFER_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'run_id') ~= ARGV[1] then
+    return -1
+end
+for i = 3, #ARGV do
+    redis.call('XADD', KEYS[2], '*', 'result', ARGV[i], 'run_id', ARGV[1])
+end
+redis.call('HINCRBY', KEYS[1], 'completed', #ARGV - 2)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return redis.call('XLEN', KEYS[2])
+"""
+
+
+def buffer_results(project_survey_id, run_id, results):
+    """
+    Append result tuples of a run to the survey's stream, update the progress counter and publish the progress.
+    Results of a run that is no longer the current one are dropped. Schedules a flush when a full batch is
+    buffered or the run has finished.
+    """
+    r = get_redis()
+    buffered = r.eval(_BUFFER_SCRIPT, 2, run_progress.progress_key(project_survey_id), stream_key(project_survey_id),
+                      run_id, run_progress.PROGRESS_TTL, *[json.dumps(result) for result in results])
+    if buffered < 0:
+        print(f"Dropped {len(results)} results of superseded run {run_id} (project survey {project_survey_id})")
+        return
+
+    run_progress.publish(r, project_survey_id)
+    if buffered >= FLUSH_BATCH_SIZE or is_run_finished(r, project_survey_id):
+        schedule_flush(r, project_survey_id)
+
+
+def read_batch(r, project_survey_id, count=FLUSH_BATCH_SIZE):
+    """Return up to `count` buffered (entry_id, run_id, result) entries after the last checkpoint."""
+    checkpoint = r.get(checkpoint_key(project_survey_id))
+    start = b'(' + checkpoint if checkpoint else '-'
+    entries = r.xrange(stream_key(project_survey_id), min=start, max='+', count=count)
+    return [
+        (entry_id, fields[b'run_id'].decode('utf-8') if b'run_id' in fields else None, json.loads(fields[b'result']))
+        for entry_id, fields in entries
+    ]
+
+
+def is_stale_entry(counters, entry_id, run_id):
+    """
+    True for an entry another run appended after the current run was planned: its task outlived a cancelled or
+    superseded run and must not be saved into the current one. Backlog of a previous run buffered before is kept.
+    """
+    if counters is None or run_id is None or run_id == counters['run_id']:
+        return False
+    return int(entry_id.split(b'-')[0]) >= counters['planned_at'] * 1000
+
+
+def acknowledge_batch(r, project_survey_id, entry_ids, persisted=None):
+    """Record the entries in the checkpoint and remove them from the stream; `persisted` of them were saved (all by default)."""
+    pipe = r.pipeline()
+    pipe.set(checkpoint_key(project_survey_id), entry_ids[-1])
+    run_progress.increment(pipe, project_survey_id, 'persisted', len(entry_ids) if persisted is None else persisted)
+    pipe.xdel(stream_key(project_survey_id), *entry_ids)
+    pipe.execute()
+
+
+@task_failure.connect
+def record_failed_survey_task(sender=None, args=None, kwargs=None, **extra):
+    """Count permanently failed query tasks so the writer can still finalize the run."""
+    if sender is None or sender.name not in SURVEY_QUERY_TASKS:
+        return
+    try:
+        arguments = inspect.signature(sender.run).bind(*(args or ()), **(kwargs or {})).arguments
+    except TypeError:
+        return
+    # query_LLM_many carries a list of query_LLM requests, the other tasks a single one
+    record_failed_requests(arguments.get('requests') or [arguments])
+
+
+def record_failed_requests(requests):
+    """Count query requests (dicts of query task arguments) that will not be answered."""
+    r = get_redis()
+    failed = {}
+    for request in requests:
+        project_survey_id = request.get('project_survey_id')
+        # Tasks left over from a superseded run do not count against the current one
+        if project_survey_id is None or request.get('run_id') != run_progress.current_run_id(r, project_survey_id):
+            continue
+        failed[project_survey_id] = failed.get(project_survey_id, 0) + len(request.get('query_template_ids') or [None])
+
+    for project_survey_id, count in failed.items():
+        pipe = r.pipeline()
+        run_progress.increment(pipe, project_survey_id, 'failed', count)
+        pipe.execute()
+        run_progress.publish(r, project_survey_id)
+        if is_run_finished(r, project_survey_id):
+            schedule_flush(r, project_survey_id)
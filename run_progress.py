@@ -0,0 +1,318 @@
+#run_progress.py
+
+"""
+Progress tracking of survey runs.
+The counters of a run (total, completed, failed and persisted tasks) live in one Redis hash per project survey
+with a TTL, so a progress read is a single round trip. Updates are published on a per-survey pub/sub channel
+and pushed to the dashboards as server-sent events instead of being polled.
+"""
+
+import json
+import time
+import uuid
+import redis
+from config import Config
+from resources import get_redis, get_pubsub_redis
+
+# Seconds the progress of a run is kept after its last update
+PROGRESS_TTL = getattr(Config, 'SURVEY_PROGRESS_TTL', 7 * 24 * 3600)
+# Minimum milliseconds between two published updates of the same run
+PUBLISH_INTERVAL_MS = getattr(Config, 'SURVEY_PROGRESS_PUBLISH_INTERVAL_MS', 500)
+# Seconds an event stream stays open before the browser reconnects
+SSE_MAX_DURATION = getattr(Config, 'SURVEY_PROGRESS_SSE_MAX_DURATION', 300)
+# Seconds between keep-alive comments on an idle stream, and before the browser reconnects
+SSE_HEARTBEAT = 15
+SSE_RECONNECT = 3
+
+COUNTERS = ('total', 'completed', 'failed', 'persisted', 'reserved', 'dispatched')
+
+# Run states: queued for the planner task, tasks being dispatched/answered, refused by the planner, or stopped by the user
+PLANNING, RUNNING, REJECTED, CANCELLED = 'planning', 'running', 'rejected', 'cancelled'
+
+
+class RunCancelled(Exception):
+    """The run was cancelled while the planner was dispatching it."""
+
+
+# Apply field updates only while the run is still in the expected state (ARGV[1]) with the expected id (ARGV[2])
+_TRANSITION_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'status', 'run_id')
+if state[1] ~= ARGV[1] or state[2] ~= ARGV[2] then
+    return 0
+end
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Cancel a run that is planning, or running with tasks still outstanding
+_CANCEL_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'status', 'total', 'completed', 'failed')
+if state[1] == 'running' then
+    if tonumber(state[3] or 0) + tonumber(state[4] or 0) >= tonumber(state[2] or 0) then
+        return 0
+    end
+elseif state[1] ~= 'planning' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', 'cancelled', 'cancelled_at', ARGV[1])
+return 1
+"""
+
+
+# Stop dispatching a planning or running run (ARGV[1]) that failed: a run without dispatched tasks is rejected with
+# the message ARGV[2], otherwise it keeps running with the dispatched tasks only. Returns the reserved credits of the
+# queries that were never dispatched, or -1 if the run was cancelled or superseded meanwhile
+_STOP_DISPATCHING_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'status', 'run_id', 'reserved', 'dispatched')
+if (state[1] ~= 'planning' and state[1] ~= 'running') or state[2] ~= ARGV[1] then
+    return -1
+end
+local reserved = tonumber(state[3] or 0)
+local dispatched = tonumber(state[4] or 0)
+if dispatched == 0 then
+    redis.call('HSET', KEYS[1], 'status', 'rejected', 'message', ARGV[2], 'reserved', 0)
+else
+    redis.call('HSET', KEYS[1], 'status', 'running', 'total', dispatched, 'reserved', dispatched)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return reserved - dispatched
+"""
+
+
+# Queue a new run (ARGV[1]) for planning unless a run is planning or still has tasks outstanding
+_PLAN_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'status', 'total', 'completed', 'failed')
+if state[1] == 'planning' then
+    return 0
+end
+if state[1] == 'running' and tonumber(state[3] or 0) + tonumber(state[4] or 0) < tonumber(state[2] or 0) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'run_id', ARGV[1], 'status', 'planning', 'total', 0, 'completed', 0, 'failed', 0,
+           'persisted', 0, 'started_at', ARGV[2], 'planned_at', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+def progress_key(project_survey_id):
+    return f"survey_progress_{project_survey_id}"
+
+def channel_key(project_survey_id):
+    return f"survey_progress_channel_{project_survey_id}"
+
+def publish_lock_key(project_survey_id):
+    return f"survey_progress_publish_lock_{project_survey_id}"
+
+
+def _reset(r, project_survey_id, run_id, status, total_tasks=0):
+    pipe = r.pipeline()
+    pipe.delete(progress_key(project_survey_id))
+    pipe.hset(progress_key(project_survey_id), mapping={
+        'run_id': run_id or '', 'status': status,
+        'total': total_tasks, 'completed': 0, 'failed': 0, 'persisted': 0, 'started_at': time.time(), 'planned_at': time.time(),
+    })
+    pipe.expire(progress_key(project_survey_id), PROGRESS_TTL)
+    pipe.execute()
+    publish(r, project_survey_id, force=True)
+
+
+def plan_run(r, project_survey_id, run_id):
+    """
+    Mark a run as queued for planning, so it shows as running before its tasks are known.
+    Returns False, leaving the progress untouched, if another run is planning or still has tasks outstanding.
+    """
+    if not r.eval(_PLAN_SCRIPT, 1, progress_key(project_survey_id), run_id, time.time(), PROGRESS_TTL):
+        return False
+    publish(r, project_survey_id, force=True)
+    return True
+
+
+def _transition(r, project_survey_id, run_id, expected_status, **fields):
+    args = [expected_status, run_id, PROGRESS_TTL]
+    for field, value in fields.items():
+        args += [field, value]
+    return bool(r.eval(_TRANSITION_SCRIPT, 1, progress_key(project_survey_id), *args))
+
+
+def start_run(r, project_survey_id, total_tasks, run_id=None):
+    """
+    Reset the counters of a project survey for a new run of `total_tasks` tasks and return the run id.
+    A run queued for planning passes its `run_id`; it only starts if it has not been cancelled meanwhile (None is returned then).
+    """
+    if run_id is None:
+        run_id = uuid.uuid4().hex
+        _reset(r, project_survey_id, run_id, RUNNING, total_tasks)
+        return run_id
+    if not _transition(r, project_survey_id, run_id, PLANNING, status=RUNNING, total=total_tasks,
+                       completed=0, failed=0, persisted=0, started_at=time.time()):
+        return None
+    publish(r, project_survey_id, force=True)
+    return run_id
+
+
+def record_reservation(r, project_survey_id, run_id, interactions):
+    """Remember the credits reserved for a planning run, so a cancellation can refund them. False if it was cancelled."""
+    return _transition(r, project_survey_id, run_id, PLANNING, reserved=interactions)
+
+
+def record_dispatched(r, project_survey_id, queries):
+    """Count queries the planner handed to the broker."""
+    pipe = r.pipeline()
+    increment(pipe, project_survey_id, 'dispatched', queries)
+    pipe.execute()
+
+
+def stop_dispatching(r, project_survey_id, run_id, message):
+    """
+    End the planning of a run that failed after its reservation was recorded. Tasks already dispatched keep running
+    and the run finishes with them; a run with nothing dispatched is rejected with `message`.
+    Returns the reserved interactions that were never dispatched, to be refunded (0 if the run was cancelled meanwhile,
+    whose cancellation refunds them).
+    """
+    refund = r.eval(_STOP_DISPATCHING_SCRIPT, 1, progress_key(project_survey_id), run_id, message, PROGRESS_TTL)
+    publish(r, project_survey_id, force=True)
+    return max(0, refund)
+
+
+def cancel_run(r, project_survey_id):
+    """Mark the current run as cancelled. Returns False if there is no planning or unfinished run."""
+    cancelled = bool(r.eval(_CANCEL_SCRIPT, 1, progress_key(project_survey_id), time.time()))
+    if cancelled:
+        publish(r, project_survey_id, force=True)
+    return cancelled
+
+
+def is_cancelled(r, project_survey_id, run_id):
+    """True if `run_id` was cancelled or is no longer the current run of the project survey (superseded or expired)."""
+    status, current_run_id = r.hmget(progress_key(project_survey_id), 'status', 'run_id')
+    return status == CANCELLED.encode() or current_run_id != run_id.encode()
+
+
+def current_run_id(r, project_survey_id):
+    """Id of the latest run of a project survey, or None."""
+    run_id = r.hget(progress_key(project_survey_id), 'run_id')
+    return run_id.decode('utf-8') if run_id else None
+
+
+def reject_run(r, project_survey_id, message):
+    """Record that the planner refused the run, with the reason shown to the user."""
+    pipe = r.pipeline()
+    pipe.hset(progress_key(project_survey_id), mapping={'status': REJECTED, 'message': message})
+    pipe.expire(progress_key(project_survey_id), PROGRESS_TTL)
+    pipe.execute()
+    publish(r, project_survey_id, force=True)
+
+
+def increment(pipe, project_survey_id, field, amount):
+    """Queue a counter increment on a pipeline, refreshing the TTL of the hash."""
+    pipe.hincrby(progress_key(project_survey_id), field, amount)
+    pipe.expire(progress_key(project_survey_id), PROGRESS_TTL)
+
+
+def read_counters(r, project_survey_id):
+    """Counters of the current run, or None if the survey has not been run."""
+    values = r.hgetall(progress_key(project_survey_id))
+    if not values:
+        return None
+    values = {key.decode('utf-8'): value for key, value in values.items()}
+    counters = {field: int(values.get(field) or 0) for field in COUNTERS}
+    counters['started_at'] = float(values.get('started_at') or time.time())
+    counters['planned_at'] = float(values.get('planned_at') or counters['started_at'])
+    counters['run_id'] = (values.get('run_id') or b'').decode('utf-8') or None
+    counters['status'] = (values.get('status') or RUNNING.encode()).decode('utf-8')
+    counters['message'] = (values.get('message') or b'').decode('utf-8') or None
+    return counters
+
+
+def is_finished(counters) -> bool:
+    """True once every task of the run has either produced a result or failed permanently, or the run was refused or cancelled."""
+    if counters is None or counters['status'] == PLANNING:
+        return False
+    return counters['status'] in (REJECTED, CANCELLED) or counters['completed'] + counters['failed'] >= counters['total']
+
+
+def snapshot(project_survey_id, counters):
+    """Progress, throughput (tasks per second) and ETA (seconds) of a run."""
+    if counters is None:
+        return {'project_survey_id': project_survey_id, 'progress': None}
+    if counters['status'] == REJECTED:
+        return {'project_survey_id': project_survey_id, 'run_id': counters['run_id'], 'progress': None,
+                'error': counters['message'], 'finished': True}
+    total = counters['total']
+    done = min(total, counters['completed'] + counters['failed'])
+    elapsed = max(time.time() - counters['started_at'], 1e-6)
+    throughput = counters['completed'] / elapsed
+    remaining = total - done
+    return {
+        'project_survey_id': project_survey_id,
+        'run_id': counters['run_id'],
+        'status': counters['status'],
+        'progress': round(done * 100 / total, 2) if total else (100 if counters['status'] == RUNNING else 0),
+        'total': total,
+        'completed': counters['completed'],
+        'failed': counters['failed'],
+        'persisted': counters['persisted'],
+        'throughput': round(throughput, 3),
+        'eta': None if counters['status'] == CANCELLED else round(remaining / throughput) if remaining and throughput else (0 if not remaining else None),
+        'finished': is_finished(counters),
+    }
+
+
+def publish(r, project_survey_id, force=False):
+    """
+    Publish the current progress of a run to its channel.
+    Updates are rate limited per survey so a burst of completed tasks produces one event; final updates always go out.
+    """
+    counters = read_counters(r, project_survey_id)
+    if not force and not is_finished(counters):
+        if not r.set(publish_lock_key(project_survey_id), 1, nx=True, px=PUBLISH_INTERVAL_MS):
+            return
+    r.publish(channel_key(project_survey_id), json.dumps(snapshot(project_survey_id, counters)))
+
+
+def get_progress(project_survey_id):
+    """Current progress snapshot of a run."""
+    return snapshot(project_survey_id, read_counters(get_redis(), project_survey_id))
+
+
+def _sse(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def event_stream(project_survey_ids):
+    """
+    Server-sent events with the progress of the given project surveys.
+    Sends the current state first, then every published update, on a single pub/sub connection.
+    The stream closes after SSE_MAX_DURATION seconds so workers are recycled; browsers reconnect on their own.
+    Subscriptions use the dedicated pub/sub pool; when all its connections are taken by other streams, the stream
+    closes at once and the browser retries later.
+    """
+    pubsub = get_pubsub_redis().pubsub(ignore_subscribe_messages=True)
+    try:
+        yield f"retry: {SSE_RECONNECT * 1000}\n\n"
+        try:
+            pubsub.subscribe(*[channel_key(project_survey_id) for project_survey_id in project_survey_ids])
+        except redis.ConnectionError as e:
+            print(f"Progress stream refused, no pub/sub connection available: {e}")
+            return
+        for project_survey_id in project_survey_ids:
+            yield _sse(get_progress(project_survey_id))
+
+        deadline = time.time() + SSE_MAX_DURATION
+        last_sent = time.time()
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=1.0)
+            if message is not None and message['type'] == 'message':
+                yield f"data: {message['data'].decode('utf-8')}\n\n"
+                last_sent = time.time()
+            elif time.time() - last_sent >= SSE_HEARTBEAT:
+                # Keep-alive comment so proxies do not close an idle connection
+                yield ": keep-alive\n\n"
+                last_sent = time.time()
+    finally:
+        pubsub.close()
@@ -0,0 +1,103 @@
+#run_spec.py
+
+"""
+Shared data of a survey run, stored once instead of being copied into every task message.
+The planner publishes a run spec (LLM settings without the API key, population prompt templates, survey texts
+and questions) to Redis. Query tasks only carry references (project survey id, run id, profile id, query template ids)
+and workers resolve the content through a per-process cache. API keys are read by the workers from the llms
+table and never travel through the broker or the result backend.
+"""
+
+import json
+import time
+from collections import OrderedDict
+from config import Config
+from models import LLM
+from resources import get_redis, get_session
+
+# Seconds a run spec is kept in Redis
+SPEC_TTL = getattr(Config, 'SURVEY_RUN_SPEC_TTL', 7 * 24 * 3600)
+# Run specs kept per worker process
+SPEC_CACHE_SIZE = 32
+# Seconds a worker trusts a cached API key (and model) of an LLM row before reading it again
+API_KEY_TTL = getattr(Config, 'LLM_API_KEY_CACHE_TTL', 300)
+
+_specs = OrderedDict()  # (project_survey_id, run_id) -> spec
+_providers = {}  # llm_id -> ((model, api_key), expires_at)
+
+
+class RunSpecMissing(LookupError):
+    """The run spec expired or belongs to another run of the project survey; the task is stale."""
+
+
+def spec_key(project_survey_id):
+    return f"survey_run_spec_{project_survey_id}"
+
+
+def publish_spec(r, project_survey_id, run_id, context, survey_template):
+    """Store the data shared by every task of a run."""
+    spec = {
+        'run_id': run_id,
+        'user_id': context.user_id,
+        'llm_id': context.llm_id,
+        'model': context.model,
+        'prompt_messages': context.prompt_messages,
+        'survey_description': survey_template.description,
+        'survey_context': survey_template.context_prompt,
+        'query_templates': {
+            str(query_template.id): {'query_text': query_template.query_text, 'schema': str(query_template.schema)}
+            for query_template in survey_template.query_templates
+        },
+    }
+    r.set(spec_key(project_survey_id), json.dumps(spec), ex=SPEC_TTL)
+
+
+def load_spec(project_survey_id, run_id):
+    """Return the spec of a run, from the process cache or Redis."""
+    cache_key = (project_survey_id, run_id)
+    spec = _specs.get(cache_key)
+    if spec is not None:
+        _specs.move_to_end(cache_key)
+        return spec
+
+    raw = get_redis().get(spec_key(project_survey_id))
+    spec = json.loads(raw) if raw is not None else None
+    if spec is None or spec['run_id'] != run_id:
+        raise RunSpecMissing(f"No spec for run {run_id} of project survey {project_survey_id}")
+
+    _specs[cache_key] = spec
+    if len(_specs) > SPEC_CACHE_SIZE:
+        _specs.popitem(last=False)
+    return spec
+
+
+def resolve_provider(llm_id):
+    """Model and API key of an LLM provider row, cached for API_KEY_TTL seconds so rotated keys are picked up."""
+    cached = _providers.get(llm_id)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    session = get_session()
+    try:
+        row = session.query(LLM.settings, LLM.api_key).filter(LLM.id == llm_id).first()
+    finally:
+        session.close()
+    provider = (row.settings, row.api_key) if row is not None else (None, None)
+    _providers[llm_id] = (provider, time.time() + API_KEY_TTL)
+    return provider
+
+
+def resolve_api_key(llm_id):
+    """API key of an LLM provider row (see resolve_provider)."""
+    return resolve_provider(llm_id)[1]
+
+
+def question(spec, query_template_id):
+    """Question text and answer schema of a query template of the run."""
+    return spec['query_templates'][str(query_template_id)]
+
+
+def messages_for(spec, population_tag):
+    """Serialized prompt template of a population tag."""
+    if population_tag not in spec['prompt_messages']:
+        print(f"No prompt_template found for population tag: {population_tag}")
+    return spec['prompt_messages'].get(population_tag, json.dumps(None))
@@ -0,0 +1,78 @@
+#scheduling.py
+
+"""
+Scheduling of survey query tasks across priority queues.
+Small runs go to an interactive queue and larger runs to a queue chosen by the owner's subscription tier,
+so one large run cannot starve everyone else. Workers consume the survey queues round-robin
+(`celery -A celery_app worker -Q celery,survey_interactive,survey_priority,survey_standard`; the queues are
+declared in celery_app).
+Within a queue, runs are interleaved by giving each run a bounded window of outstanding tasks that the
+planner refills as answers come in, instead of enqueueing whole runs at once.
+"""
+
+import time
+from config import Config
+from celery_app import celery
+from models import SubscriptionTier
+
+INTERACTIVE_QUEUE = 'survey_interactive'
+PRIORITY_QUEUE = 'survey_priority'
+STANDARD_QUEUE = 'survey_standard'
+SURVEY_QUEUES = (INTERACTIVE_QUEUE, PRIORITY_QUEUE, STANDARD_QUEUE)
+
+# Runs with at most this many queries are treated as interactive whatever the tier
+INTERACTIVE_MAX_QUERIES = getattr(Config, 'SURVEY_INTERACTIVE_MAX_QUERIES', 200)
+
+TIER_QUEUES = {
+    SubscriptionTier.ENTERPRISE.value: PRIORITY_QUEUE,
+    SubscriptionTier.ADVANCED.value: PRIORITY_QUEUE,
+    SubscriptionTier.STARTER.value: STANDARD_QUEUE,
+}
+
+# Queries a run may have waiting in the broker at once, per tier
+DEFAULT_TIER_WINDOWS = {
+    SubscriptionTier.ENTERPRISE.value: 2000,
+    SubscriptionTier.ADVANCED.value: 1000,
+    SubscriptionTier.STARTER.value: 500,
+}
+
+
+def queue_for_run(tier, total_queries):
+    """Queue the query tasks of a run are sent to."""
+    if total_queries <= INTERACTIVE_MAX_QUERIES:
+        return INTERACTIVE_QUEUE
+    return TIER_QUEUES.get(tier, STANDARD_QUEUE)
+
+
+def outstanding_window(tier, total_queries):
+    """Maximum number of unanswered queries a run keeps in the broker."""
+    if total_queries <= INTERACTIVE_MAX_QUERIES:
+        return total_queries
+    windows = getattr(Config, 'SURVEY_TIER_OUTSTANDING_QUERIES', DEFAULT_TIER_WINDOWS)
+    return windows.get(tier, min(windows.values()))
+
+
+# Seconds queue depths are reused before the broker is asked again
+QUEUE_DEPTHS_TTL = 5
+
+_queue_depths = (0, None)  # (expires_at, depths)
+
+
+def queue_depths():
+    """Number of messages waiting in each survey queue, read from the broker at most every QUEUE_DEPTHS_TTL seconds."""
+    global _queue_depths
+    expires_at, depths = _queue_depths
+    if depths is not None and expires_at > time.time():
+        return depths
+    depths = {}
+    with celery.connection_for_read() as connection:
+        channel = connection.default_channel
+        for queue in SURVEY_QUEUES + ('celery',):
+            try:
+                depths[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+            except Exception:
+                # The queue has not been declared yet; some brokers close the channel on a failed passive declare
+                depths[queue] = 0
+                channel = connection.channel()
+    _queue_depths = (time.time() + QUEUE_DEPTHS_TTL, depths)
+    return depths
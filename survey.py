@@ -4,74 +4,171 @@ Core survey execution module.
 Handles survey filtering, execution, progress tracking, and result processing using Celery tasks.
 """
 
-from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, defer
+from sqlalchemy import text, update, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from filter import Filter
-from models import ProfileModel, SurveyTemplate, Interaction, Project, ProjectSurvey, FilterModel
+from models import ProfileModel, SurveyTemplate, Interaction, Project, ProjectSurvey, FilterModel, Subscription
+from models import ScaleAnswer, OpenEndedAnswer, MultipleChoiceAnswer, YesNoAnswer, RankingAnswer
+from answer_schema import parse_answer
 from config import Config
 from datetime import datetime
-from celery import chord, shared_task
+import time
+from celery import group, shared_task
 from celery_app import celery
-from profile import Profile
-import redis
-from vector_utils import VectorSearch
+from profile import Profile, SurveyRunContext
+from vector_utils import get_vector_search
+import embedding_index  # registers the profile change tracking of the embedding indexes
+import embedding_cache
+from resources import get_session, get_redis
+import result_stream
+import run_progress
+import run_spec
+import scheduling
+import response_cache
 
+# Query signatures sent to the broker per dispatched group
+PLAN_BATCH_SIZE = getattr(Config, 'SURVEY_PLAN_BATCH_SIZE', 500)
+BACKPRESSURE_POLL_INTERVAL = 1
+# Seconds without any answered query after which the planner dispatches anyway
+BACKPRESSURE_MAX_STALL = 60
+# Minimum similarity of a profile to a segment's AI filter
+AI_FILTER_THRESHOLD = 0.32
 
-def collect_results(result_parameters):
-    """Save survey interactions to database and update completion status."""
+# Typed answer table of each answer schema and the column holding the answer
+ANSWER_TABLES = {
+    "ScaleSchema": (ScaleAnswer, 'rating'),
+    "OpenEndedSchema": (OpenEndedAnswer, 'response'),
+    "MultipleChoiceSchema": (MultipleChoiceAnswer, 'choice'),
+    "YesNoSchema": (YesNoAnswer, 'answer'),
+}
+
+
+def build_answer_rows(result_parameters):
+    """Parse answers into rows of the typed answer tables, grouped by model. Rankings give one row per ranked item."""
+    answer_rows = {}
+    for result in result_parameters:
+        schema, value = parse_answer(result['answer_text'])
+        if schema is None:
+            continue
+        key = {
+            'project_survey_id': result['project_survey_id'],
+            'query_template_id': result['template_id'],
+            'profile_id': result['profile_id'],
+            'user_id': result['user_id'],
+        }
+        if schema == "RankingSchema":
+            answer_rows.setdefault(RankingAnswer, []).extend(
+                {**key, 'rank': rank, 'item': item} for rank, item in enumerate(value, start=1)
+            )
+        else:
+            model, column = ANSWER_TABLES[schema]
+            answer_rows.setdefault(model, []).append({**key, column: value})
+    return answer_rows
+
+
+def collect_results(result_parameters, completion_percentage=100):
+    """Save survey interactions to database and update completion status. Returns True on success."""
     
-    # Step 1: Create a database session using config details
-    engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    if not result_parameters:
+        return True
+
+    # Step 1: Create a database session on the pooled engine
+    session = get_session()
 
     try:
-        # Step 2: Iterate over the extracted result parameters
-        for result in result_parameters:
-            interaction = Interaction(
-                user_id=result['user_id'],
-                profile_id=result['profile_id'],
-                query_text=result['query_text'],
-                answer_text=result['answer_text'],
-                query_cost=result['query_cost'],
-                template_id=result['template_id'],
-                project_survey_id=result['project_survey_id'],
-                interaction_timestamp=datetime.utcnow()
-            )
+        # Step 2: Build the rows for all interactions
+        timestamp = datetime.utcnow()
+        rows = [
+            {
+                'user_id': result['user_id'],
+                'profile_id': result['profile_id'],
+                'query_text': result['query_text'],
+                'answer_text': result['answer_text'],
+                'query_cost': result['query_cost'],
+                'template_id': result['template_id'],
+                'project_survey_id': result['project_survey_id'],
+                'prompt_tokens': result.get('prompt_tokens'),
+                'completion_tokens': result.get('completion_tokens'),
+                'llm_model': result.get('llm_model'),
+                'interaction_timestamp': timestamp
+            }
+            for result in result_parameters
+        ]
+
+        # Step 3: Write all interactions with a single multi-row insert.
+        # Delivery is at least once: a redelivered result of an already saved answer is skipped.
+        inserted = session.execute(
+            pg_insert(Interaction.__table__)
+            .on_conflict_do_nothing(index_elements=['project_survey_id', 'profile_id', 'template_id'])
+            .returning(Interaction.project_survey_id, Interaction.profile_id, Interaction.template_id),
+            rows
+        ).all()
+        saved = {tuple(row) for row in inserted}
+        result_parameters = [
+            result for result in result_parameters
+            if (result['project_survey_id'], result['profile_id'], result['template_id']) in saved
+        ]
 
-            print('*** '+str(result)+' ***')
-            # Step 3: Add the interaction to the session
-            session.add(interaction)
+        # Step 3b: Parse the answers once into the typed answer tables read by the analysis queries
+        for model, answer_rows in build_answer_rows(result_parameters).items():
+            session.execute(pg_insert(model.__table__).on_conflict_do_nothing(), answer_rows)
 
-            # Step 4: Update the completion percentage for the project survey to 100%
-            project_survey = session.query(ProjectSurvey).filter_by(id=result['project_survey_id']).first()
-            if project_survey:
-                project_survey.completion_percentage = 100
-                session.add(project_survey)
+        # Step 4: Update completion percentage and token totals once per affected project survey;
+        # skipped duplicates add no tokens
+        token_totals = {row['project_survey_id']: (0, 0) for row in rows}
+        for result in result_parameters:
+            prompt_total, completion_total = token_totals.get(result['project_survey_id'], (0, 0))
+            token_totals[result['project_survey_id']] = (
+                prompt_total + (result.get('prompt_tokens') or 0),
+                completion_total + (result.get('completion_tokens') or 0)
+            )
+        for project_survey_id, (prompt_total, completion_total) in sorted(token_totals.items()):
+            session.execute(
+                update(ProjectSurvey)
+                .where(ProjectSurvey.id == project_survey_id)
+                .values(
+                    completion_percentage=completion_percentage,
+                    prompt_tokens=func.coalesce(ProjectSurvey.prompt_tokens, 0) + prompt_total,
+                    completion_tokens=func.coalesce(ProjectSurvey.completion_tokens, 0) + completion_total
+                )
+                .execution_options(synchronize_session=False)
+            )
 
         # Step 5: Commit the session to save all interactions and updates in the database
         session.commit()
         print(f"Successfully saved {len(result_parameters)} interactions and updated completion percentages.")
+        return True
 
     except Exception as e:
         # Rollback if any error occurs
         session.rollback()
         print(f"Error occurred while saving interactions: {e}")
+        return False
 
     finally:
         # Close the session
         session.close()
 
 
-@shared_task(name='survey.process_survey_results')
-def process_survey_results(results):
-    """ Celery task to process survey responses and save interactions. """
+def _flatten_results(results):
+    """Expand batched task results (a list of result tuples per profile) into single result tuples."""
+    for result in results:
+        if result and isinstance(result[0], (list, tuple)):
+            yield from result
+        else:
+            yield result
+
+
+def build_result_parameters(results):
+    """Convert raw query task result tuples into interaction parameters."""
     # Initialize a list to store the parameters for each result
     result_parameters = []
 
-    for result in results:
-        # unpack the values based on their position
-        answer_text, prompt_tokens, completion_tokens, user_id, profile_id, query_template_id, query_text, project_survey_id = result
+    for result in _flatten_results(results):
+        # unpack the values based on their position (results queued before token accounting carry no model)
+        answer_text, prompt_tokens, completion_tokens, user_id, profile_id, query_template_id, query_text, project_survey_id, *extra = result
+        llm_model = extra[0] if extra else None
 
         query_cost = prompt_tokens + completion_tokens
 
@@ -83,26 +180,104 @@ def process_survey_results(results):
             'answer_text': answer_text,
             'query_cost': query_cost,
             'template_id': query_template_id,
-            'project_survey_id': project_survey_id 
+            'project_survey_id': project_survey_id,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'llm_model': llm_model
         })
 
-        print(f"Processed result for profile {profile_id}: query='{query_text}', answer='{answer_text}'")
-        
-    # Call collect_results to save the interactions
-    collect_results(result_parameters)
-    
+    print(f"Processed {len(result_parameters)} survey results")
     return result_parameters
 
+
+@shared_task(name='survey.flush_survey_results', bind=True, max_retries=5, default_retry_delay=10)
+def flush_survey_results(self, project_survey_id):
+    """
+    Writer task: drain buffered results of a survey run into the interactions table in bounded batches.
+    Each batch is committed before its stream entries are checkpointed, so a failure never loses persisted answers.
+    """
+    r = get_redis()
+    r.delete(result_stream.flush_scheduled_key(project_survey_id))
+
+    while True:
+        # Only one writer per survey at a time
+        if not r.set(result_stream.writer_lock_key(project_survey_id), 1, nx=True, ex=result_stream.WRITER_LOCK_TIMEOUT):
+            return
+        try:
+            while True:
+                batch = result_stream.read_batch(r, project_survey_id)
+                if not batch:
+                    break
+                entry_ids = [entry_id for entry_id, _, _ in batch]
+                counters = run_progress.read_counters(r, project_survey_id)
+                # Answers of tasks that outlived a cancelled or superseded run are not saved into the current one
+                results = [result for entry_id, run_id, result in batch if not result_stream.is_stale_entry(counters, entry_id, run_id)]
+                if len(results) < len(batch):
+                    print(f"Skipped {len(batch) - len(results)} results of a superseded run for project survey {project_survey_id}")
+                completion_percentage = _completion_percentage(counters, len(results))
+
+                if results and not collect_results(build_result_parameters(results), completion_percentage=completion_percentage):
+                    raise self.retry()
+                result_stream.acknowledge_batch(r, project_survey_id, entry_ids, len(results))
+                print(f"Flushed {len(results)} results for project survey {project_survey_id} ({completion_percentage}%)")
+
+            counters = run_progress.read_counters(r, project_survey_id)
+            if run_progress.is_finished(counters):
+                _finalize_survey_run(project_survey_id, _completion_percentage(counters))
+                run_progress.publish(r, project_survey_id, force=True)
+        finally:
+            r.delete(result_stream.writer_lock_key(project_survey_id))
+
+        # Results buffered while the lock was held may have had their flush request deduplicated
+        buffered = r.xlen(result_stream.stream_key(project_survey_id))
+        if not buffered or (buffered < result_stream.FLUSH_BATCH_SIZE and not result_stream.is_run_finished(r, project_survey_id)):
+            return
+
+
+def _completion_percentage(counters, flushing=0):
+    """
+    Share of the run persisted once `flushing` more results are saved. Only a finished run with every
+    answer saved reaches 100; runs with permanently failed tasks or cancelled runs stay below 100 so they can be resumed.
+    """
+    if counters is None or not counters['total']:
+        return 0
+    persisted = counters['persisted'] + flushing
+    if run_progress.is_finished(counters) and persisted >= counters['completed'] >= counters['total']:
+        return 100
+    return min(99, int(persisted * 100 / counters['total']))
+
+
+def _finalize_survey_run(project_survey_id, completion_percentage=100):
+    """Record the final completion of a finished run, including runs whose remaining tasks all failed."""
+    session = get_session()
+    try:
+        session.execute(
+            update(ProjectSurvey)
+            .where(ProjectSurvey.id == project_survey_id)
+            .values(completion_percentage=completion_percentage)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    finally:
+        session.close()
+
+    if response_cache.is_enabled():
+        print(f"Response cache after project survey {project_survey_id}: {response_cache.cache_stats()}")
+
+
 class Survey:
     """ Survey execution manager handling profile filtering and distributed surveying. """
     def __init__(self, filter_obj: Filter, session: Session, survey_template: SurveyTemplate, 
-                 custom_parameters_dict: dict = None, max_respondents: int = None):
+                 custom_parameters_dict: dict = None, max_respondents: int = None, batch_questions: bool = False,
+                 async_execution: bool = False):
         self.filter = filter_obj
         self.session = session
         self.survey_template = survey_template
         self.custom_parameters_dict = custom_parameters_dict or {}
         self.max_respondents = max_respondents
-        self.vector_search = VectorSearch()  # Initialize VectorSearch
+        self.batch_questions = batch_questions  # answer all questions of a profile in one LLM call
+        self.async_execution = async_execution  # run many completions concurrently per worker process
+        self.vector_search = get_vector_search()  # Shared, sets up its embedding client only when an AI filter is used
 
     def get_filtered_profiles(self, project_survey_id=None):
         # Get project survey and associated project/population
@@ -122,13 +297,19 @@ class Survey:
         # Get the filter model to check for AI filter
         filter_model = self.session.query(FilterModel).filter_by(id=project_survey.segment_id).first()
         
-        # If there's an AI filter, apply vector search
+        # If there's an AI filter, apply vector search (its result is cached per segment and population version)
         if filter_model and filter_model.ai_filter:
-            profile_ids = self.vector_search.find_similar_profiles_from_query(
-                query=filter_model.ai_filter,
-                base_query=query,
-                similarity_threshold=0.32  
-            )
+            r = get_redis()
+            segment_key = embedding_cache.segment_key(filter_model, population.tag, AI_FILTER_THRESHOLD, embedding_cache.population_version(r))
+            profile_ids = embedding_cache.lookup_segment(r, segment_key)
+            if profile_ids is None:
+                profile_ids = self.vector_search.find_similar_profiles_from_query(
+                    query=filter_model.ai_filter,
+                    base_query=query,
+                    similarity_threshold=AI_FILTER_THRESHOLD,
+                    population_tag=population.tag
+                )
+                embedding_cache.store_segment(r, segment_key, profile_ids)
             # Filter the query to only include matched profiles
             if profile_ids:
                 query = query.filter(ProfileModel.id.in_(profile_ids))
@@ -136,78 +317,321 @@ class Survey:
                 # If no profiles match the AI filter, return empty list
                 return []
         
-        # Apply respondent limit
+        # Embeddings and chunks are not needed to build the prompts
+        query = query.options(
+            defer(ProfileModel.llm_persona_embeddings),
+            defer(ProfileModel.llm_typical_day_embeddings),
+            defer(ProfileModel.llm_persona_chunks),
+            defer(ProfileModel.llm_typical_day_chunks),
+        )
+
+        # Apply respondent limit (ordered, so a resumed run targets the same respondents)
+        query = query.order_by(ProfileModel.id)
         if self.max_respondents is not None:
             query = query.limit(self.max_respondents)
         
         return query.all()
 
-    def run_survey(self, project_survey_id=None):
-        """Execute survey on filtered profiles after cleaning previous data."""
-        
-        cleanup_survey_data(project_survey_id)
-        filtered_profiles = self.get_filtered_profiles(project_survey_id)
-        return self._survey_profiles(filtered_profiles, project_survey_id=project_survey_id)
+    def count_pending_queries(self, filtered_profiles, answered=None):
+        """Number of (profile, question) pairs a run over `filtered_profiles` will ask."""
+        answered = answered or set()
+        return sum(
+            1 for profile_model in filtered_profiles for query_template in self.survey_template.query_templates
+            if (profile_model.id, query_template.id) not in answered
+        )
 
-    def _survey_profiles(self, filtered_profiles, project_survey_id=None):
-        r = redis.Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
+    def _survey_profiles(self, filtered_profiles, project_survey_id=None, answered=None, run_id=None):
+        r = get_redis()
         
         query_templates = self.survey_template.query_templates
+        answered = answered or set()
         task_group = []
-        total_tasks = len(filtered_profiles) * len(query_templates)
+        total_tasks = self.count_pending_queries(filtered_profiles, answered)
+        dispatched = 0
         
-        # Set the total number of tasks in Redis and reset completed tasks
-        r.set(f"survey_total_tasks_{project_survey_id}", total_tasks)
-        r.set(f"survey_completed_tasks_{project_survey_id}", 0)
+        # Reset buffered results and the progress counters of the previous run
+        result_stream.reset_stream(r, project_survey_id)
+        run_id = run_progress.start_run(r, project_survey_id, total_tasks, run_id)
+        if run_id is None:
+            return "Run cancelled before it started."
+
+        if total_tasks == 0:
+            _finalize_survey_run(project_survey_id)
+            return "All respondents have already answered every question."
         
         # Retrieve the user_id associated with the project
         project_survey = self.session.query(ProjectSurvey).filter_by(id=project_survey_id).first()
         project = self.session.query(Project).filter_by(id=project_survey.project_id).first()
         user_id = project.user_id
-        for profile_model in filtered_profiles:
-            profile = Profile.from_model(self.session, profile_model)
-            for query_template in query_templates:
-                # Enqueue the query
-                task = profile.enqueue_query(
-                    user_id=user_id,
-                    profile_id=profile_model.id,
-                    query=query_template.query_text,
-                    schema=query_template.schema,
-                    query_template_id=query_template.id,
-                    project_survey_id=project_survey_id,
-                    survey_description=self.survey_template.description, 
-                    survey_context=self.survey_template.context_prompt
-                )
-                task_group.append(task)
-                print(f"Profile ID: {profile_model.id}, Name: {profile_model.profile_name}")
-                print(f"Queued task for query template '{query_template.name}'")
-        batch = chord(task_group)(celery.signature('survey.process_survey_results'))
-        print('\n\nchord: ' + str(batch.id))
-        return f"{len(filtered_profiles)} profiles surveyed with {len(query_templates)} query templates."
+        # Route the run by the owner's tier and size, and bound how much of it waits in the broker at once
+        tier = self.session.query(Subscription.tier).filter_by(user_id=user_id).scalar()
+        queue = scheduling.queue_for_run(tier, total_tasks)
+        window = scheduling.outstanding_window(tier, total_tasks)
+        batch_size = max(1, min(PLAN_BATCH_SIZE, window))
+        print(f"Project survey {project_survey_id}: {total_tasks} queries on queue {queue} (window {window})")
+
+        # Publish the user LLM settings, population prompt templates and questions once for the whole run;
+        # tasks only reference them
+        run_context = SurveyRunContext.load(self.session, user_id, {profile_model.tags for profile_model in filtered_profiles})
+        run_spec.publish_spec(r, project_survey_id, run_id, run_context, self.survey_template)
+        refreshed_summaries = 0
+        try:
+            for profile_model in filtered_profiles:
+                # Dispatch in bounded batches so signatures never pile up in memory and the broker is not flooded
+                if len(task_group) >= batch_size:
+                    refreshed_summaries = self._commit_summaries(refreshed_summaries)
+                    dispatched += self._dispatch(r, task_group, project_survey_id, dispatched, queue, window)
+                    task_group = []
+                # Profiles without a current materialized summary get one stored; workers read it from there
+                refreshed_summaries += Profile.materialize_summary(profile_model)
+                # In resume mode only the questions this profile has not answered yet are asked
+                pending_templates = [query_template for query_template in query_templates if (profile_model.id, query_template.id) not in answered]
+                if not pending_templates:
+                    continue
+                if self.batch_questions and len(pending_templates) > 1:
+                    # One task answers every question for this profile
+                    task_group.append(Profile.enqueue_batch_query(
+                        profile_id=profile_model.id,
+                        query_template_ids=[query_template.id for query_template in pending_templates],
+                        project_survey_id=project_survey_id,
+                        run_id=run_id
+                    ))
+                    print(f"Profile ID: {profile_model.id}, Name: {profile_model.profile_name}")
+                    continue
+                for query_template in pending_templates:
+                    # Enqueue the query
+                    task_group.append(Profile.enqueue_query(
+                        profile_id=profile_model.id,
+                        query_template_id=query_template.id,
+                        project_survey_id=project_survey_id,
+                        run_id=run_id
+                    ))
+                    print(f"Profile ID: {profile_model.id}, Name: {profile_model.profile_name}")
+                    print(f"Queued task for query template '{query_template.name}'")
+            self._commit_summaries(refreshed_summaries)
+            if task_group:
+                dispatched += self._dispatch(r, task_group, project_survey_id, dispatched, queue, window)
+        except run_progress.RunCancelled:
+            self._commit_summaries(refreshed_summaries)
+            return f"Run cancelled after dispatching {dispatched} of {total_tasks} queries."
+
+        return f"{len(filtered_profiles)} profiles surveyed with {len(query_templates)} query templates ({total_tasks} queries)."
+
+    def _commit_summaries(self, refreshed_summaries):
+        """Commit refreshed profile summaries before the tasks that read them are dispatched."""
+        if refreshed_summaries:
+            self.session.commit()
+            print(f"Materialized {refreshed_summaries} profile summaries")
+        return 0
+
+    def _dispatch(self, r, task_group, project_survey_id, dispatched, queue, window):
+        """
+        Send one batch of query signatures to `queue` once it fits in the run's window of unanswered queries.
+        Keeping each run to a window interleaves the runs sharing a queue. Returns the number of queries in the batch.
+        """
+        queries = sum(len(task.kwargs.get('query_template_ids') or [None]) for task in task_group)
+        # Backpressure: wait for the workers to catch up before adding more work to the broker.
+        # A run that makes no progress at all (e.g. the planner occupies the only worker) is not waited on forever.
+        last_done, stalled_since = None, time.time()
+        while True:
+            counters = run_progress.read_counters(r, project_survey_id)
+            if counters is not None and counters['status'] == run_progress.CANCELLED:
+                raise run_progress.RunCancelled()
+            done = counters['completed'] + counters['failed'] if counters else 0
+            if dispatched + queries - done <= window:
+                break
+            if done != last_done:
+                last_done, stalled_since = done, time.time()
+            elif time.time() - stalled_since > BACKPRESSURE_MAX_STALL:
+                break
+            time.sleep(BACKPRESSURE_POLL_INTERVAL)
+
+        if self.async_execution:
+            task_group = self._group_async_requests(task_group)
+
+        # Results are streamed to the database by survey.flush_survey_results as tasks complete
+        batch = group(task_group).apply_async(queue=queue)
+        run_progress.record_dispatched(r, project_survey_id, queries)
+        print(f"Dispatched {queries} queries for project survey {project_survey_id} (group {batch.id})")
+        return queries
+
+    @staticmethod
+    def _group_async_requests(task_group):
+        """Pack single-question signatures into query_LLM_many tasks executed on the worker's event loop."""
+        chunk_size = getattr(Config, 'LLM_ASYNC_TASK_SIZE', 50)
+        requests = [task.kwargs for task in task_group if task.task == 'profile.query_LLM']
+        grouped = [task for task in task_group if task.task != 'profile.query_LLM']
+        for start in range(0, len(requests), chunk_size):
+            grouped.append(celery.signature('profile.query_LLM_many', args=(requests[start:start + chunk_size],)))
+        return grouped
         
         
 def get_survey_progress(project_survey_id):
-    """Calculate survey completion percentage from Redis task counters."""
-    
-    r = redis.Redis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, db=Config.REDIS_DB)
-    total_tasks_raw = r.get(f"survey_total_tasks_{project_survey_id}")
+    """Calculate survey completion percentage from the run's progress hash."""
     
-    if total_tasks_raw is None:  # Survey hasn't started yet
+    # Permanently failed tasks are done as far as the run is concerned; they can be retried with a resume
+    return run_progress.get_progress(project_survey_id)['progress']
+     
+def drain_previous_run(project_survey_id):
+    """Persist whatever a previous run still has buffered. Returns False if another writer still holds the results."""
+    r = get_redis()
+    if r.xlen(result_stream.stream_key(project_survey_id)):
+        flush_survey_results(project_survey_id)
+    return not r.xlen(result_stream.stream_key(project_survey_id))
+
+
+def reserve_interactions(session, user_id, respondents_count, interactions_count):
+    """
+    Check the subscription limits of a run and deduct its interactions.
+    Returns an error message if the run is not allowed, None once the credits are reserved.
+    """
+    subscription = session.query(Subscription).filter_by(user_id=user_id).first()
+    if not subscription or not subscription.is_active:
+        return "No active subscription found"
+    if respondents_count > subscription.max_respondents_per_survey:
+        return f"Respondents per survey limit exceeded. Maximum allowed: {subscription.max_respondents_per_survey}"
+    # Conditional update, so concurrent runs of the same user cannot overdraw the credits
+    reserved = session.execute(
+        update(Subscription)
+        .where(Subscription.id == subscription.id, Subscription.remaining_interactions >= interactions_count)
+        .values(remaining_interactions=Subscription.remaining_interactions - interactions_count)
+    ).rowcount
+    session.commit()
+    if not reserved:
+        return f"Insufficient interaction credits. Available: {subscription.remaining_interactions}"
+    return None
+
+
+@shared_task(name='survey.plan_survey_run', bind=True)
+def plan_survey_run(self, project_survey_id, resume=False):
+    """
+    Planner task: select the respondents of a project survey, check and reserve credits, then fan out
+    the query tasks in bounded batches. Runs outside the HTTP request so web latency does not depend on survey size.
+    The task id is the run id.
+    """
+    run_id = self.request.id
+    r = get_redis()
+    session = get_session()
+    reserved, recorded, user_id = 0, False, None
+    try:
+        project_survey = session.query(ProjectSurvey).filter_by(id=project_survey_id).first()
+        if project_survey is None:
+            return run_progress.reject_run(r, project_survey_id, "Survey no longer exists")
+        project = session.query(Project).filter_by(id=project_survey.project_id).first()
+        user_id = project.user_id
+        filter_model = session.query(FilterModel).filter_by(id=project_survey.segment_id).first()
+        survey_template = session.query(SurveyTemplate).filter_by(id=project_survey.survey_template_id).first()
+
+        survey = Survey(Filter.from_model(filter_model), session, survey_template, custom_parameters_dict={},
+                        max_respondents=project_survey.respondents,
+                        batch_questions=getattr(Config, 'SURVEY_BATCH_QUESTIONS', False),
+                        async_execution=getattr(Config, 'SURVEY_ASYNC_EXECUTION', False))
+
+        if resume and not drain_previous_run(project_survey_id):
+            return run_progress.reject_run(r, project_survey_id, "Results of the previous run are still being saved, resume later.")
+        filtered_profiles = survey.get_filtered_profiles(project_survey_id)
+        if not filtered_profiles:
+            return run_progress.reject_run(r, project_survey_id, "No profiles match the segment criteria.")
+        answered = get_answered_pairs(session, project_survey_id) if resume else set()
+
+        # Only the queries that will actually be asked are charged
+        interactions = survey.count_pending_queries(filtered_profiles, answered)
+        error = reserve_interactions(session, user_id, len(filtered_profiles), interactions)
+        if error:
+            return run_progress.reject_run(r, project_survey_id, error)
+        reserved = interactions
+        if not run_progress.record_reservation(r, project_survey_id, run_id, reserved):
+            # Cancelled while planning, before the reservation could be recorded for a refund
+            refund_interactions(session, user_id, reserved)
+            return "Run cancelled before it started."
+        # From here on a cancellation refunds the recorded reservation
+        recorded = True
+
+        if not resume:
+            cleanup_survey_data(project_survey_id)
+            session.execute(update(ProjectSurvey).where(ProjectSurvey.id == project_survey_id).values(completion_percentage=0))
+            session.commit()
+        message = survey._survey_profiles(filtered_profiles, project_survey_id=project_survey_id, answered=answered, run_id=run_id)
+        print(message)
+        return message
+    except Exception as e:
+        session.rollback()
+        message = "The survey could not be started, please try again."
+        if recorded:
+            # Queries already dispatched keep running; the credits of those never dispatched are refunded
+            refund_interactions(session, user_id, run_progress.stop_dispatching(r, project_survey_id, run_id, message))
+            # The dispatched queries may all be answered already
+            if result_stream.is_run_finished(r, project_survey_id):
+                result_stream.schedule_flush(r, project_survey_id)
+        else:
+            refund_interactions(session, user_id, reserved)
+            run_progress.reject_run(r, project_survey_id, message)
+        print(f"Planning project survey {project_survey_id} failed: {e}")
+        raise
+    finally:
+        session.close()
+
+
+def refund_interactions(session, user_id, interactions):
+    """Give unused interaction credits back to the user's subscription."""
+    if interactions <= 0:
+        return
+    session.execute(
+        update(Subscription)
+        .where(Subscription.user_id == user_id)
+        .values(remaining_interactions=Subscription.remaining_interactions + interactions)
+    )
+    session.commit()
+
+
+def cancel_survey_run(project_survey_id):
+    """
+    Stop the current run of a project survey. Queued tasks of the run are skipped by the workers and the planner
+    stops dispatching, answers already produced are kept, and credits reserved for unanswered queries are refunded.
+    Returns the number of refunded interactions, or None if there was no run to cancel.
+    """
+    r = get_redis()
+    if not run_progress.cancel_run(r, project_survey_id):
         return None
-        
-    total_tasks = int(total_tasks_raw)
-    completed_tasks = int(r.get(f"survey_completed_tasks_{project_survey_id}") or 0)
-    
-    if total_tasks == 0:
-        return 0
-    
-    progress = (completed_tasks / total_tasks) * 100
-    return round(progress, 2)
+    counters = run_progress.read_counters(r, project_survey_id)
+    # The planner may still be waiting in the queue
+    celery.control.revoke(counters['run_id'])
+
+    refund = max(0, counters['reserved'] - counters['completed'])
+    session = get_session()
+    try:
+        user_id = session.query(Project.user_id).join(ProjectSurvey, ProjectSurvey.project_id == Project.id)\
+            .filter(ProjectSurvey.id == project_survey_id).scalar()
+        refund_interactions(session, user_id, refund)
+    finally:
+        session.close()
+
+    # The writer persists what is still buffered and records the final completion percentage
+    result_stream.schedule_flush(r, project_survey_id)
+    print(f"Cancelled run {counters['run_id']} of project survey {project_survey_id}, refunded {refund} interactions")
+    return refund
+
+
+def get_answered_pairs(session, project_survey_id):
+    """Return the (profile_id, query_template_id) pairs that already have an answer for the project survey."""
+    rows = session.query(Interaction.profile_id, Interaction.template_id)\
+        .filter(Interaction.project_survey_id == project_survey_id)\
+        .distinct()\
+        .all()
+    return {(profile_id, template_id) for profile_id, template_id in rows}
+
+
+def is_survey_run_active(project_survey_id):
+    """True while a dispatched run still has tasks that neither completed nor failed."""
+    counters = run_progress.read_counters(get_redis(), project_survey_id)
+    return counters is not None and not run_progress.is_finished(counters)
+
      
 def cleanup_survey_data(project_survey_id):
-    """Remove previous survey data using stored procedure."""
-    engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
-    session = sessionmaker(bind=engine)()
+    """Remove previous survey data using stored procedure, and its typed answers."""
+    session = get_session()
     session.execute(text(f"CALL sp_cleanup_survey_data({project_survey_id});"))
+    for model in (ScaleAnswer, OpenEndedAnswer, MultipleChoiceAnswer, YesNoAnswer, RankingAnswer):
+        session.query(model).filter(model.project_survey_id == project_survey_id).delete(synchronize_session=False)
     session.commit()
     session.close()
\ No newline at end of file
@@ -0,0 +1,171 @@
+#survey_load_driver.py
+
+"""
+End-to-end load test of the survey pipeline (planner -> query_LLM -> result stream -> collect_results)
+against the mock LLM provider in mock_llm.py.
+Creates a synthetic project survey over existing profiles of a population, runs the planner in this process,
+lets the Celery workers answer and persist it, and reports throughput, per-stage latency and database write rate.
+
+The workers must be running and configured with the mock provider settings (Config.MOCK_LLM), e.g.
+    MOCK_LLM = {'latency': {'distribution': 'lognormal', 'median': 0.8}, 'error_rate': 0.01, 'record_latencies': True}
+
+Usage:
+    python survey_load_driver.py --population-tag US --respondents 1000 --questions 5 [--batch] [--async] [--keep]
+"""
+
+import argparse
+import statistics
+import time
+import uuid
+from itertools import cycle
+from config import Config
+from models import User, LLM, Subscription, Project, Population, FilterModel, QueryTemplate, SurveyTemplate, ProjectSurvey, Interaction
+from resources import get_session, get_redis
+from answer_schema import schema_mapping
+from mock_llm import MOCK_LLM_ID, LATENCY_KEY
+from survey import plan_survey_run
+import run_progress
+
+
+def create_fixtures(session, population_tag, respondents, questions):
+    """Create a throwaway user, project, segment and survey answered by the mock provider."""
+    population = session.query(Population).filter_by(tag=population_tag).first()
+    if population is None:
+        raise SystemExit(f"Unknown population tag: {population_tag}")
+
+    if session.query(LLM).get(MOCK_LLM_ID) is None:
+        session.add(LLM(id=MOCK_LLM_ID, name='Mock', description='Local mock provider for load tests', settings='mock-model'))
+
+    user = User(email=f"loadtest+{uuid.uuid4().hex[:12]}@example.invalid", full_name='Load test', is_confirmed=True, llm_id=MOCK_LLM_ID)
+    session.add(user)
+    session.flush()
+    session.add(Subscription(user_id=user.id, tier='ENTERPRISE', is_active=True, max_projects=10000,
+                             max_respondents_per_survey=10 ** 7, max_interactions_per_month=10 ** 9, remaining_interactions=10 ** 9))
+    project = Project(name='Load test', description='Synthetic survey pipeline load test', user_id=user.id, population_id=population.id)
+    session.add(project)
+    session.flush()
+    segment = FilterModel(project_id=project.id, alias='Load test - all profiles')
+    query_templates = [
+        QueryTemplate(name=f"Load test question {index + 1}", query_text=f"Synthetic load test question {index + 1}?", schema=schema)
+        for index, schema in zip(range(questions), cycle(schema_mapping))
+    ]
+    survey_template = SurveyTemplate(name='Load test survey', description='Synthetic load test survey', context_prompt='',
+                                     user_id=user.id, query_templates=query_templates)
+    session.add_all([segment, survey_template])
+    session.flush()
+    project_survey = ProjectSurvey(project_id=project.id, survey_template_id=survey_template.id, survey_alias='Load test',
+                                   segment_id=segment.id, respondents=respondents)
+    session.add(project_survey)
+    session.commit()
+    return {'user_id': user.id, 'project_id': project.id, 'segment_id': segment.id, 'survey_template_id': survey_template.id,
+            'query_template_ids': [query_template.id for query_template in query_templates], 'project_survey_id': project_survey.id}
+
+
+def remove_fixtures(session, fixtures):
+    """Delete everything create_fixtures and the run created."""
+    session.query(Interaction).filter(Interaction.project_survey_id == fixtures['project_survey_id']).delete(synchronize_session=False)
+    session.query(ProjectSurvey).filter_by(id=fixtures['project_survey_id']).delete(synchronize_session=False)
+    session.delete(session.query(SurveyTemplate).get(fixtures['survey_template_id']))
+    session.flush()
+    session.query(QueryTemplate).filter(QueryTemplate.id.in_(fixtures['query_template_ids'])).delete(synchronize_session=False)
+    session.query(FilterModel).filter_by(id=fixtures['segment_id']).delete(synchronize_session=False)
+    session.query(Project).filter_by(id=fixtures['project_id']).delete(synchronize_session=False)
+    session.query(Subscription).filter_by(user_id=fixtures['user_id']).delete(synchronize_session=False)
+    session.query(User).filter_by(id=fixtures['user_id']).delete(synchronize_session=False)
+    session.commit()
+
+
+def run(project_survey_id, timeout, poll_interval):
+    """Plan the run in this process and sample its progress counters until it is persisted. Returns the timings."""
+    r = get_redis()
+    r.delete(LATENCY_KEY)
+    run_id = uuid.uuid4().hex
+    if not run_progress.plan_run(r, project_survey_id, run_id):
+        raise SystemExit(f"Project survey {project_survey_id} is still running")
+
+    started = time.time()
+    plan_survey_run.apply(args=(project_survey_id,), task_id=run_id)
+    planned = time.time()
+
+    samples = []  # (seconds since start, completed, failed, persisted)
+    while True:
+        counters = run_progress.read_counters(r, project_survey_id)
+        samples.append((time.time() - started, counters['completed'], counters['failed'], counters['persisted']))
+        if run_progress.is_finished(counters) and counters['persisted'] >= counters['completed']:
+            break
+        if time.time() - started > timeout:
+            print(f"Timed out after {timeout}s")
+            break
+        time.sleep(poll_interval)
+    return {'planning': planned - started, 'samples': samples, 'counters': counters}
+
+
+def _first_time(samples, predicate):
+    return next((sample[0] for sample in samples if predicate(sample)), None)
+
+
+def _percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def report(timings, session, project_survey_id):
+    samples, counters = timings['samples'], timings['counters']
+    if counters['status'] == run_progress.REJECTED:
+        print(f"Run refused by the planner: {counters['message']}")
+        return
+    total = counters['total']
+    first_answer = _first_time(samples, lambda sample: sample[1] > 0)
+    answered = _first_time(samples, lambda sample: sample[1] + sample[2] >= total)
+    first_write = _first_time(samples, lambda sample: sample[3] > 0)
+    persisted = _first_time(samples, lambda sample: sample[3] >= counters['completed'] and sample[1] + sample[2] >= total)
+    rows = session.query(Interaction).filter(Interaction.project_survey_id == project_survey_id).count()
+    project_survey = session.query(ProjectSurvey).get(project_survey_id)
+
+    print(f"Queries:                {total} ({counters['completed']} answered, {counters['failed']} failed)")
+    print(f"Planning + dispatch:    {timings['planning']:.2f}s")
+    if first_answer is not None:
+        print(f"Time to first answer:   {first_answer:.2f}s")
+    if answered is not None:
+        print(f"Answering:              {answered:.2f}s ({counters['completed'] / max(answered, 1e-6):.1f} answers/s)")
+    if persisted is not None and answered is not None:
+        print(f"Persistence lag:        {max(0, persisted - answered):.2f}s after the last answer")
+    if persisted is not None and first_write is not None:
+        print(f"DB writes:              {rows} rows, {rows / max(persisted - first_write, 1e-6):.1f} rows/s")
+    print(f"Tokens:                 {project_survey.prompt_tokens or 0} prompt, {project_survey.completion_tokens or 0} completion")
+
+    latencies = [float(value) for value in get_redis().lrange(LATENCY_KEY, 0, -1)]
+    if latencies:
+        print(f"Provider latency:       p50 {statistics.median(latencies):.2f}s, p95 {_percentile(latencies, 0.95):.2f}s, "
+              f"p99 {_percentile(latencies, 0.99):.2f}s over {len(latencies)} calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the survey pipeline with the mock LLM provider.")
+    parser.add_argument('--population-tag', required=True, help="population whose existing profiles answer the survey")
+    parser.add_argument('--respondents', type=int, default=100)
+    parser.add_argument('--questions', type=int, default=5)
+    parser.add_argument('--batch', action='store_true', help="answer all questions of a profile in one call")
+    parser.add_argument('--async', dest='async_execution', action='store_true', help="run completions on the workers' event loops")
+    parser.add_argument('--timeout', type=int, default=3600)
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--keep', action='store_true', help="keep the synthetic survey and its answers")
+    args = parser.parse_args()
+
+    # Read by the planner, which runs in this process
+    Config.SURVEY_BATCH_QUESTIONS = args.batch
+    Config.SURVEY_ASYNC_EXECUTION = args.async_execution
+
+    session = get_session()
+    fixtures = create_fixtures(session, args.population_tag, args.respondents, args.questions)
+    try:
+        timings = run(fixtures['project_survey_id'], args.timeout, args.poll_interval)
+        report(timings, session, fixtures['project_survey_id'])
+    finally:
+        if not args.keep:
+            remove_fixtures(session, fixtures)
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
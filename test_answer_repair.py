@@ -0,0 +1,61 @@
+#test_answer_repair.py
+
+"""Tests of the local answer repair: scale detection used to clamp ratings and passthrough of valid answers."""
+
+import json
+import pytest
+from answer_repair import scale_range, repair
+
+
+@pytest.mark.parametrize('query_text, expected', [
+    ("On a scale of 1 to 10, how satisfied are you?", (1, 10)),
+    ("How likely are you to recommend us, on a scale from 0 to 10?", (0, 10)),
+    ("Rate the service from 1 to 7.", (1, 7)),
+    ("On a 1-5 scale, how much do you trust the news?", (1, 5)),
+    ("On a 0–10 point scale, how likely are you to switch?", (0, 10)),
+    ("Using a 1 through 4 rating scale, how often do you cook?", (1, 4)),
+    ("How would you rate our service (1-10)?", (1, 10)),
+    ("Rate from 1 (poor) to 10 (excellent).", (1, 10)),
+    ("On a scale of 1 (not at all) to 10 (completely), how safe do you feel?", (1, 10)),
+])
+def test_explicit_scales(query_text, expected):
+    assert scale_range(query_text) == expected
+
+
+def test_other_ranges_are_ignored():
+    assert scale_range("People aged 18-30: on a scale of 1 to 5, how much do you enjoy concerts?") == (1, 5)
+
+
+def test_last_scale_wins():
+    assert scale_range("On a scale of 1 to 10 (or, if easier, on a scale of 1 to 5), how happy are you?") == (1, 5)
+
+
+@pytest.mark.parametrize('query_text', [
+    "How much do you spend on groceries per week?",
+    "How many of the people aged 18-30 you know own a car?",
+    "On a scale of 5 to 1, how tired are you?",
+    "",
+    None,
+])
+def test_no_scale(query_text):
+    assert scale_range(query_text) is None
+
+
+@pytest.mark.parametrize('content, query_text, expected', [
+    ('{"rating": 8}', "How would you rate our service (1-10)?", 8),
+    ('{"rating": 9}', "Rate from 1 (poor) to 10 (excellent).", 9),
+    ('{"rating": 12}', "How would you rate our service (1-10)?", 10),
+    ('{"rating": 8}', "How would you rate our service?", 8),
+])
+def test_ratings_clamped_only_to_a_stated_scale(content, query_text, expected):
+    assert json.loads(repair(content, 'ScaleSchema', query_text)) == {'rating': expected}
+
+
+@pytest.mark.parametrize('content, expected', [
+    ('{"choice": "Public transport"}', "Public transport"),
+    ('{"choice": "public transport."}', "Public transport"),
+    ('{"choice": "b) Public transport"}', "Public transport"),
+])
+def test_choices_keep_the_option_text(content, expected):
+    query_text = "How do you usually get to work: a) Car, b) Public transport or c) Bicycle?"
+    assert json.loads(repair(content, 'MultipleChoiceSchema', query_text)) == {'choice': expected}
@@ -0,0 +1,150 @@
+#token_usage.py
+
+"""
+Token accounting for LLM calls.
+Reads token usage from provider responses when available and falls back to a local tokenizer estimate.
+The structured LLM wrappers return the parsed answer instead of the provider response, so the usage of the
+underlying chat/completion calls is collected from llama_index instrumentation events while a call is counted.
+Also provides aggregated usage reports per project survey, user and model.
+"""
+
+import contextvars
+from contextlib import contextmanager
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.llm import LLMChatEndEvent, LLMCompletionEndEvent
+from sqlalchemy import func
+from models import Interaction
+from config import Config
+
+try:
+    import tiktoken
+except ImportError:  # tokenizer is optional, a character-based estimate is used instead
+    tiktoken = None
+
+_encodings = {}
+# Usage reported by the provider calls of the LLM call being counted in this thread or asyncio task
+_captured = contextvars.ContextVar('token_usage_captured', default=None)
+
+
+def _encoding_for(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Non-OpenAI models: cl100k_base is a close enough approximation
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def estimate_tokens(text: str, model: str) -> int:
+    """Estimate the number of tokens of `text` with a local tokenizer."""
+    if not text:
+        return 0
+    encoding = _encoding_for(model)
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _read_usage(source):
+    """Extract (prompt_tokens, completion_tokens) from a usage dict/object, or None."""
+    if source is None:
+        return None
+    usage = source.get('usage') if isinstance(source, dict) else getattr(source, 'usage', None)
+    usage = usage if usage is not None else source
+    get = usage.get if isinstance(usage, dict) else lambda key: getattr(usage, key, None)
+    prompt_tokens, completion_tokens = get('prompt_tokens'), get('completion_tokens')
+    if isinstance(prompt_tokens, int) and isinstance(completion_tokens, int):
+        return prompt_tokens, completion_tokens
+    return None
+
+
+def usage_from_response(response):
+    """Token usage reported by the provider, or None when the response does not carry it."""
+    return _read_usage(getattr(response, 'raw', None)) or _read_usage(getattr(response, 'additional_kwargs', None))
+
+
+class _UsageHandler(BaseEventHandler):
+    """Records the usage carried by every chat/completion response into the capture of the current call."""
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenUsageHandler"
+
+    def handle(self, event, **kwargs):
+        captured = _captured.get()
+        if captured is None or not isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            return
+        usage = usage_from_response(event.response)
+        if usage is not None:
+            captured.append(usage)
+
+
+get_dispatcher().add_event_handler(_UsageHandler())
+
+
+@contextmanager
+def capture():
+    """Collect the provider-reported usage of the LLM calls made inside the block; yields a list of (prompt, completion) pairs."""
+    captured = []
+    token = _captured.set(captured)
+    try:
+        yield captured
+    finally:
+        _captured.reset(token)
+
+
+def count_tokens(response, prompt: str, content: str, model: str, captured=None):
+    """
+    Return (prompt_tokens, completion_tokens) for a completion: the usage of the response, or the usage `captured`
+    from its provider calls, estimating locally only if neither is available.
+    """
+    usage = usage_from_response(response)
+    if usage is not None:
+        return usage
+    if captured:
+        return tuple(sum(tokens) for tokens in zip(*captured))
+    return estimate_tokens(prompt, model), estimate_tokens(content, model)
+
+
+def split_tokens(total: int, parts: int):
+    """Distribute a token count over `parts` answers of a batched call."""
+    share, remainder = divmod(total, parts)
+    return [share + (1 if index < remainder else 0) for index in range(parts)]
+
+
+def usage_report(session, project_survey_id=None, user_id=None):
+    """Aggregate token usage per project survey, user and model."""
+    query = session.query(
+        Interaction.project_survey_id,
+        Interaction.user_id,
+        Interaction.llm_model,
+        func.count(Interaction.interaction_id).label('interactions'),
+        func.coalesce(func.sum(Interaction.prompt_tokens), 0).label('prompt_tokens'),
+        func.coalesce(func.sum(Interaction.completion_tokens), 0).label('completion_tokens'),
+    )
+    if project_survey_id is not None:
+        query = query.filter(Interaction.project_survey_id == project_survey_id)
+    if user_id is not None:
+        query = query.filter(Interaction.user_id == user_id)
+    query = query.group_by(Interaction.project_survey_id, Interaction.user_id, Interaction.llm_model)
+
+    # Optional prices per 1k tokens: {model: (prompt_price, completion_price)}
+    prices = getattr(Config, 'LLM_TOKEN_PRICES', {})
+    report = []
+    for row in query.all():
+        entry = {
+            'project_survey_id': row.project_survey_id,
+            'user_id': row.user_id,
+            'model': row.llm_model,
+            'interactions': row.interactions,
+            'prompt_tokens': int(row.prompt_tokens),
+            'completion_tokens': int(row.completion_tokens),
+        }
+        if row.llm_model in prices:
+            prompt_price, completion_price = prices[row.llm_model]
+            entry['estimated_cost'] = round((entry['prompt_tokens'] * prompt_price + entry['completion_tokens'] * completion_price) / 1000, 6)
+        report.append(entry)
+    return report
@@ -5,42 +5,60 @@ Vector search implementation using NVIDIA embeddings for semantic profile matchi
 Provides similarity search across profile data using embedding comparisons.
 """
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from llama_index.embeddings.nvidia import NVIDIAEmbedding
 import numpy as np
-from models import ProfileModel, ProfileView, LLM
-from collections import defaultdict
-from config import Config
+from models import ProfileModel, ProfileView
+import embedding_cache
+import run_spec
+from resources import get_embedding_client, get_session
+from sqlalchemy import func
 from typing import List 
 
+# LLM row holding the NVIDIA API key used for embeddings
+EMBEDDING_LLM_ID = 0
+
+_vector_search = None
+
+
+def get_vector_search():
+    """Return the process-wide VectorSearch, created on first use."""
+    global _vector_search
+    if _vector_search is None:
+        _vector_search = VectorSearch()
+    return _vector_search
+
+
 # Could not use Llamaindex's PGVectorStore features because pgvector is not supported on Postgress17 and I'm using Windows on my dev environment :(
 class VectorSearch:
-    """Handles semantic search over profile data using NVIDIA embeddings."""
+    """
+    Handles semantic search over profile data using NVIDIA embeddings.
+    Nothing is set up on construction: the embedding client is created on the first query and shared by the process
+    (see resources.get_embedding_client), and the API key of the NVIDIA LLM row is re-read every
+    run_spec.API_KEY_TTL seconds, so a rotated key replaces the client without a restart.
+    Use get_vector_search() for the process-wide instance.
+    """
     def __init__(
         self,
         embedding_model: str = "nvidia/llama-3.2-nv-embedqa-1b-v1",
     ):
-        self.engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
-        self.Session = sessionmaker(bind=self.engine)
-        
-        # Get API key from database
-        session = self.Session()
-        try:
-            llm = session.query(LLM).filter_by(id=0).first()
-            if not llm or not llm.api_key:
-                raise ValueError("Could not find API key in database")
-            api_key = llm.api_key
-        finally:
-            session.close()
-            
-        self.embedder = NVIDIAEmbedding(model=embedding_model, api_key=api_key)
+        self.Session = get_session
+        self.embedding_model = embedding_model
+
+    @property
+    def embedder(self):
+        _, api_key = run_spec.resolve_provider(EMBEDDING_LLM_ID)
+        if not api_key:
+            raise ValueError("Could not find API key in database")
+        return get_embedding_client(self.embedding_model, api_key)
+
+    def embed(self, text: str):
+        return self.embedder.get_text_embedding(text)
 
     def find_similar_profiles_from_query(
             self, 
             query: str,
             base_query,
             similarity_threshold: float = 0.5,
+            population_tag: str = None,
         ) -> List[int]:
             """
             Find similar profiles from a pre-filtered query.
@@ -49,6 +67,7 @@ class VectorSearch:
                 query: Search query text
                 base_query: Pre-filtered SQLAlchemy query (from ProfileView)
                 similarity_threshold: Minimum similarity score (0-1) to include in results
+                population_tag: Population of the candidates; its memory-mapped embedding index is used when built
             """
             # Create a new clean query just for IDs from ProfileView
             clean_base_query = base_query.with_entities(ProfileView.id)
@@ -57,44 +76,42 @@ class VectorSearch:
             if not matching_profile_ids:
                 return []
                 
-            query_embedding = self.embedder.get_text_embedding(query)
-            
+            query_embedding = embedding_cache.get_query_embedding(self.embed, self.embedding_model, query)
+
+            index = None
+            if population_tag:
+                import embedding_index
+                index = embedding_index.get_index(population_tag)
+                if index is None:
+                    embedding_index.schedule_build(population_tag)
+
+            if index is None:
+                profile_ids, scores = self._score_from_database(matching_profile_ids, query_embedding, similarity_threshold)
+            else:
+                positions, missing_ids = index.locate(matching_profile_ids)
+                profile_ids, scores = index.profile_ids[positions], index.score(positions, query_embedding, similarity_threshold)
+                if len(missing_ids):
+                    # Profiles created since the index was built
+                    missing_profile_ids, missing_scores = self._score_from_database(missing_ids.tolist(), query_embedding, similarity_threshold)
+                    profile_ids = np.concatenate([profile_ids, missing_profile_ids])
+                    scores = np.concatenate([scores, missing_scores])
+            return ranked_profile_ids(profile_ids, scores)
+
+    def _score_from_database(self, profile_ids: List[int], query_embedding, similarity_threshold: float):
+            """Read the chunk embeddings of profiles from the database and score them. Returns (profile ids, scores)."""
             session = self.Session()
             try:
-                # Now query ProfileModel with these IDs to get vector data
-                profiles = session.query(ProfileModel).filter(
-                    ProfileModel.id.in_(matching_profile_ids),
+                # Only the chunk embeddings of the candidates are needed, not the whole profiles or the chunk texts
+                rows = session.query(*chunk_embedding_columns()).filter(
+                    ProfileModel.id.in_(profile_ids),
                     (ProfileModel.llm_persona_embeddings.isnot(None)) |
                     (ProfileModel.llm_typical_day_embeddings.isnot(None))
                 ).all()
-                
-                profile_scores = defaultdict(float)
-                
-                for profile in profiles:
-                    # Process persona chunks
-                    if profile.llm_persona_chunks and profile.llm_persona_embeddings:
-                        for embedding in profile.llm_persona_embeddings:
-                            similarity = self.cosine_similarity(query_embedding, embedding)
-                            if similarity >= similarity_threshold:
-                                profile_scores[profile.id] += similarity
-                    
-                    # Process typical day chunks
-                    if profile.llm_typical_day_chunks and profile.llm_typical_day_embeddings:
-                        for embedding in profile.llm_typical_day_embeddings:
-                            similarity = self.cosine_similarity(query_embedding, embedding)
-                            if similarity >= similarity_threshold:
-                                profile_scores[profile.id] += similarity
-                
-                sorted_profiles = sorted(
-                    profile_scores.items(),
-                    key=lambda x: x[1],
-                    reverse=True
-                )
-                
-                return [profile_id for profile_id, score in sorted_profiles if score > 0]
-                
             finally:
                 session.close()
+
+            scored_ids, embeddings, owners = stack_chunk_embeddings(rows)
+            return scored_ids, score_profiles(embeddings, owners, len(scored_ids), query_embedding, similarity_threshold)
             
     @staticmethod
     def cosine_similarity(embedding1: List[float], embedding2: List[float]) -> float:
@@ -105,3 +122,72 @@ class VectorSearch:
             np.linalg.norm(embedding1) * np.linalg.norm(embedding2)
         )
 
+
+def has_elements(array_column):
+    """SQL expression that is true when an array column holds at least one element."""
+    return func.coalesce(func.cardinality(array_column), 0) > 0
+
+
+def chunk_embedding_columns():
+    """Columns read to score a profile: id, whether it has persona chunks, their embeddings, and the same for its typical day."""
+    return (
+        ProfileModel.id,
+        has_elements(ProfileModel.llm_persona_chunks),
+        ProfileModel.llm_persona_embeddings,
+        has_elements(ProfileModel.llm_typical_day_chunks),
+        ProfileModel.llm_typical_day_embeddings,
+    )
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale each row to unit length in place; all-zero rows stay zero and never match."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+def stack_chunk_embeddings(rows, keep_empty: bool = False):
+    """
+    Stack the chunk embeddings of profiles into one pre-normalized float32 matrix.
+    `rows` are (id, has persona chunks, persona embeddings, has typical day chunks, typical day embeddings); chunk
+    embeddings only count when the profile also has the chunks. Profiles without any are left out unless `keep_empty`.
+    Returns (profile ids, matrix, owner index of every matrix row).
+    """
+    profile_ids, embeddings, owners = [], [], []
+    for profile_id, persona_chunks, persona_embeddings, typical_day_chunks, typical_day_embeddings in rows:
+        chunk_embeddings = []
+        if persona_chunks and persona_embeddings:
+            chunk_embeddings.extend(persona_embeddings)
+        if typical_day_chunks and typical_day_embeddings:
+            chunk_embeddings.extend(typical_day_embeddings)
+        if not chunk_embeddings and not keep_empty:
+            continue
+        owners.extend([len(profile_ids)] * len(chunk_embeddings))
+        profile_ids.append(profile_id)
+        embeddings.extend(chunk_embeddings)
+    if not embeddings:
+        return np.asarray(profile_ids, dtype=np.int64), np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+    matrix = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    return np.asarray(profile_ids, dtype=np.int64), matrix, np.asarray(owners, dtype=np.int64)
+
+
+def score_profiles(matrix: np.ndarray, owners: np.ndarray, profile_count: int, query_embedding, similarity_threshold: float) -> np.ndarray:
+    """
+    Score profiles against a query with one matrix-vector product over their normalized chunk embeddings:
+    a profile's score is the sum of the cosine similarities of its chunks that reach the threshold.
+    """
+    if not len(owners):
+        return np.zeros(profile_count, dtype=np.float32)
+    query_vector = np.asarray(query_embedding, dtype=np.float32)
+    query_vector = query_vector / (np.linalg.norm(query_vector) or 1)
+    similarities = matrix @ query_vector
+    similarities[similarities < similarity_threshold] = 0
+    # Segment sums of the chunk similarities per owning profile
+    return np.bincount(owners, weights=similarities, minlength=profile_count)
+
+
+def ranked_profile_ids(profile_ids: np.ndarray, scores: np.ndarray) -> List[int]:
+    """Ids of the profiles with a positive score, best first."""
+    order = np.argsort(-scores, kind='stable')
+    return [int(profile_id) for profile_id in profile_ids[order][scores[order] > 0]]